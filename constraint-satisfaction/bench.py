@@ -0,0 +1,151 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+import nqueens
+import scheduler
+import sudoku
+
+# Runs a fixed corpus of problems and writes what every solve cost as
+# JSON, so two versions of the solver can be compared run for run, e.g.
+#   python bench.py -o before.json
+#   ...change csp.py...
+#   python bench.py --compare before.json
+# Value order is shuffled, so every solve starts from the same seed and
+# the node counts only change when the search itself does
+
+# Hard 9x9 puzzles, blanks as '.'
+HARD_SUDOKU = {
+    "inkala": "8..........36......7..9.2...5...7.......457.....1...3...1....68..85...1..9....4..",
+    "ai-escargot": "1....7.9..3..2...8..96..5....53..9...1..8...26....4...3......1..4......7..7...3..",
+    "top95-1": "4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......",
+    "hardest-1": "..53.....8......2..7..1.5..4....53...1..7...6..32...8..6.5....9..4....3......97..",
+    "hardest-2": "12..4......5.69.1...9...5.........7.7...52.9..3......2.9.6...5.4..9..8.1..3...9.4",
+    "hardest-3": "...57..3.1......2.7...234......8...4..7..4...49....6.5.42...3.....7..9....18.....",
+}
+
+# The full team from scheduler.py's later steps
+TEAM = scheduler.ALL_PEOPLE + ["Doug", "Ethan", "Frank"]
+
+def parseSudoku(line):
+    size = int(len(line) ** 0.5)
+    return [
+        [0 if symbol == "." else int(symbol) for symbol in line[row * size:(row + 1) * size]]
+        for row in range(size)
+    ]
+
+def corpus(**options):
+    # (suite, name, a function building a fresh CSP), options
+    # go to every CSP on top of the model's own
+    instances = []
+    for n in (8, 16, 32, 64, 128):
+        instances.append(("queens", f"queens-{n}", lambda n=n: nqueens.queensCSP(n, **options)))
+    for name, line in HARD_SUDOKU.items():
+        instances.append(("sudoku", f"sudoku-{name}",
+                          lambda line=line: sudoku.sudokuCSP(parseSudoku(line), **options)))
+    for weeks, end in ((2, "2024-12-06"), (6, "2025-01-03"), (13, "2025-02-21"),
+                       (26, "2025-05-23"), (52, "2025-11-21")):
+        instances.append(("scheduler", f"roster-{weeks}w",
+                          lambda end=end: scheduler.rosterCSP("2024-11-23", end, TEAM, **options)))
+    return instances
+
+def run(build, seed, repeat):
+    # Same seed every time, so only the wall time should differ between repeats
+    times = []
+    for _ in range(repeat):
+        csp = build()
+        random.seed(seed)
+        start = time.perf_counter()
+        solution = csp.solve()
+        times.append(time.perf_counter() - start)
+    return {
+        "solved": solution is not None,
+        "nodes": csp.stats.nodes,
+        "backtracks": csp.stats.backtracks,
+        "restarts": csp.stats.restarts,
+        "cacheHitRate": csp.stats.hitRate(),
+        "seconds": statistics.median(times),
+    }
+
+def benchmark(seed=0, repeat=3, only=None, **options):
+    results = {}
+    for suite, name, build in corpus(**options):
+        if only and not any(part in name for part in only):
+            continue
+        result = run(build, seed, repeat)
+        result["suite"] = suite
+        results[name] = result
+        print(f"{name}: {result['seconds']:.3f}s, {result['nodes']} nodes, "
+              f"{result['backtracks']} backtracks", file=sys.stderr)
+    return {
+        "seed": seed,
+        "repeat": repeat,
+        "options": options,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+def compare(before, after, tolerance=0.2):
+    # Prints every instance side by side and returns the names of
+    # those that got slower by more than tolerance or stopped solving
+    if before["seed"] != after["seed"]:
+        print(f"Warning: seeds differ ({before['seed']} vs {after['seed']}), "
+              "node counts aren't comparable")
+    slower = []
+    print(f"{'instance':<22}{'nodes':>22}{'seconds':>24}")
+    for name, new in after["results"].items():
+        old = before["results"].get(name)
+        if old is None:
+            print(f"{name:<22}{'new':>22}")
+            continue
+        ratio = new["seconds"] / max(old["seconds"], 1e-9)
+        notes = []
+        if new["nodes"] != old["nodes"]:
+            notes.append("search changed")
+        if old["solved"] and not new["solved"]:
+            notes.append("NO LONGER SOLVED")
+            slower.append(name)
+        elif ratio > 1 + tolerance and new["seconds"] - old["seconds"] > 0.01:
+            # Anything that only takes a few milliseconds is mostly noise
+            notes.append("SLOWER")
+            slower.append(name)
+        print(f"{name:<22}{old['nodes']:>10} -> {new['nodes']:<10}"
+              f"{old['seconds']:>9.3f}s -> {new['seconds']:.3f}s ({ratio:.2f}x)  {', '.join(notes)}")
+    return slower
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CSP solver")
+    parser.add_argument("-o", "--output", help="file for the JSON results, stdout if left out")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per instance, the median time is kept")
+    parser.add_argument("--only", nargs="+", help="only instances with one of these in their name")
+    parser.add_argument("--variable-order", help="variable_order for every CSP, the model's own if left out")
+    parser.add_argument("--value-order", help="value_order for every CSP, the model's own if left out")
+    parser.add_argument("--cache-size", type=int, help="cache_size for every CSP, no cache if left out")
+    parser.add_argument("--compare", help="earlier JSON results, exits with 1 if anything got slower")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed before it counts")
+    args = parser.parse_args()
+
+    options = {}
+    if args.variable_order:
+        options["variable_order"] = args.variable_order
+    if args.value_order:
+        options["value_order"] = args.value_order
+    if args.cache_size:
+        options["cache_size"] = args.cache_size
+    results = benchmark(args.seed, args.repeat, args.only, **options)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as old:
+            if compare(json.load(old), results, args.tolerance):
+                sys.exit(1)
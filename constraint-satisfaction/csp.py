@@ -1,52 +1,1519 @@
+import multiprocessing
 import random
+import time
+from collections import OrderedDict
+
+class Constraint:
+    def __init__(self, fn, scope=None, pure=False):
+        # fn(var, value, assignment) -> bool
+        self.fn = fn
+        # Variables this constraint reads, None means it
+        # could involve any variable
+        self.scope = None if scope is None else list(scope)
+        # Pure constraints only ever look at var, value and the values
+        # of the scope, so the solver may cache what they return
+        if pure and scope is None:
+            raise ValueError("A pure constraint needs a scope")
+        self.pure = pure
+        # What to call it in the solver's stats, subclasses
+        # checking with their own method go by the class name
+        if getattr(fn, "__self__", None) is self:
+            self.name = type(self).__name__
+        else:
+            self.name = getattr(fn, "__qualname__", repr(fn))
+
+    def __call__(self, var, value, assignment):
+        return self.fn(var, value, assignment)
+
+    # Stateful constraints can keep running counters instead of
+    # scanning the assignment. The solver calls onAssign/onUnassign
+    # for every variable in the scope as it is set and removed, so
+    # by the time fn is called the counters match the assignment
+
+    def reset(self):
+        # Called before every search, stateful constraints start over here
+        pass
+
+    def onAssign(self, var, value):
+        pass
+
+    def onUnassign(self, var, value):
+        pass
+
+    def stateful(self):
+        return (
+            type(self).onAssign is not Constraint.onAssign
+            or type(self).onUnassign is not Constraint.onUnassign
+        )
+
+    def culprits(self, var, value, assignment):
+        # Assigned variables that can be to blame when var can't take
+        # value. Subclasses that know better can narrow this down
+        if self.scope is None:
+            return {other for other in assignment if other != var}
+        return {other for other in self.scope if other != var and other in assignment}
+
+    def propagate(self, csp, assignment):
+        # Prune values from the domains of the variables in our scope.
+        # Returns the variables whose domains shrank, or None if one emptied
+        if self.scope is None:
+            # We don't know what we read, so we can't prune anything
+            return []
+        if len(self.scope) == 2:
+            return self.revise(csp, assignment)
+        return self.forwardCheck(csp, assignment)
+
+    def forwardCheck(self, csp, assignment):
+        # Drop any value that already conflicts with the assigned variables
+        changed = []
+        for var in self.scope:
+            if var in assignment:
+                continue
+            for value in list(csp.store.values(var)):
+                if not self.fn(var, value, assignment):
+                    csp.prune(var, value, self.culprits(var, value, assignment) if csp.backjumping else None)
+                    if var not in changed:
+                        changed.append(var)
+            if csp.store.size(var) == 0:
+                return None
+        return changed
+
+    def revise(self, csp, assignment):
+        # AC-3 style revision of both arcs of a binary constraint,
+        # a value is only kept if the other side still has a value
+        # that goes along with it
+        changed = []
+        for var, other in (self.scope, reversed(self.scope)):
+            if var in assignment:
+                continue
+            for value in list(csp.store.values(var)):
+                if not self.supported(csp, var, value, other, assignment):
+                    csp.prune(var, value)
+                    if var not in changed:
+                        changed.append(var)
+            if csp.store.size(var) == 0:
+                return None
+        return changed
+
+    def supported(self, csp, var, value, other, assignment):
+        if other in assignment:
+            return self.fn(var, value, assignment)
+        for otherValue in csp.store.values(other):
+            # Try it out, keeping our own counters in step
+            assignment[other] = otherValue
+            self.onAssign(other, otherValue)
+            ok = self.fn(var, value, assignment)
+            self.onUnassign(other, otherValue)
+            del assignment[other]
+            if ok:
+                return True
+        return False
+
+class AllDifferent(Constraint):
+    # Every variable in the scope takes a different value.
+    # Propagation follows Regin: find a maximum matching of
+    # variables to values, then drop every value that can't
+    # be part of any maximum matching
+    def __init__(self, scope):
+        super().__init__(self.check, scope)
+        # Last matching found, a good starting point for the next one
+        self.matching = {}
+
+    def check(self, var, value, assignment):
+        for other in self.scope:
+            if other != var and other in assignment and assignment[other] == value:
+                return False
+        return True
+
+    def propagate(self, csp, assignment):
+        domains = {var: set(csp.store.values(var)) for var in self.scope}
+        match = self.findMatching(domains)
+        if match is None:
+            # More variables than values left to give them
+            return None
+        self.matching = match
+        owner = {value: var for var, value in match.items()}
+
+        # Values that can reach a free value along an alternating path.
+        # Walking var -> value (unmatched) -> var (matched) backwards from
+        # every free value. Any edge into one of these values is fine
+        users = {}
+        for var, values in domains.items():
+            for value in values:
+                if value != match[var]:
+                    users.setdefault(value, []).append(var)
+        reachesFree = set()
+        queue = [value for value in users if value not in owner]
+        reachesFree.update(queue)
+        while queue:
+            value = queue.pop()
+            for var in users.get(value, []):
+                matched = match[var]
+                if matched not in reachesFree:
+                    reachesFree.add(matched)
+                    queue.append(matched)
+
+        # Everything else has to live inside a strongly connected component
+        component = self.components(domains, match, owner)
+
+        changed = []
+        for var, values in domains.items():
+            for value in values:
+                if value == match[var] or value in reachesFree:
+                    continue
+                if component[(0, var)] == component[(1, value)]:
+                    continue
+                csp.prune(var, value)
+                if var not in changed:
+                    changed.append(var)
+        return changed
+
+    def findMatching(self, domains):
+        # Keep whatever is still valid from last time,
+        # then augment the rest one variable at a time
+        match = {}
+        owner = {}
+        for var, value in self.matching.items():
+            if var in domains and value in domains[var] and value not in owner:
+                match[var] = value
+                owner[value] = var
+
+        def augment(var, seen):
+            for value in domains[var]:
+                if value in seen:
+                    continue
+                seen.add(value)
+                if value not in owner or augment(owner[value], seen):
+                    match[var] = value
+                    owner[value] = var
+                    return True
+            return False
+
+        for var in self.scope:
+            if var not in match and not augment(var, set()):
+                return None
+        return match
+
+    def components(self, domains, match, owner):
+        # Iterative Tarjan over the graph where unmatched edges go
+        # var -> value and matched edges go value -> var
+        def edges(node):
+            kind, item = node
+            if kind == 0:
+                return [(1, value) for value in domains[item] if value != match[item]]
+            if item in owner:
+                return [(0, owner[item])]
+            return []
+
+        nodes = [(0, var) for var in domains]
+        nodes += [(1, value) for value in set().union(*domains.values())]
+        index = {}
+        low = {}
+        component = {}
+        stack = []
+        onStack = set()
+        counter = 0
+        for root in nodes:
+            if root in index:
+                continue
+            work = [(root, iter(edges(root)))]
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            onStack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        onStack.add(child)
+                        work.append((child, iter(edges(child))))
+                        break
+                    if child in onStack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        while True:
+                            member = stack.pop()
+                            onStack.discard(member)
+                            component[member] = node
+                            if member == node:
+                                break
+        return component
+
+class GlobalCardinality(Constraint):
+    # Bounds how many variables in the scope can take each value,
+    # bounds maps value -> (min, max). Counts of assigned values are
+    # kept up to date by the assign/unassign hooks instead of being
+    # recounted on every call
+    def __init__(self, scope, bounds):
+        super().__init__(self.check, scope)
+        self.bounds = dict(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = {value: 0 for value in self.bounds}
+        self.unassigned = len(self.scope)
+
+    def onAssign(self, var, value):
+        self.unassigned -= 1
+        if value in self.counts:
+            self.counts[value] += 1
+
+    def onUnassign(self, var, value):
+        self.unassigned += 1
+        if value in self.counts:
+            self.counts[value] -= 1
+
+    def check(self, var, value, assignment):
+        # Counts as they would be with var set to value
+        def countOf(other):
+            count = self.counts[other]
+            if var in assignment and assignment[var] == other:
+                count -= 1
+            if other == value:
+                count += 1
+            return count
+
+        if value in self.bounds and countOf(value) > self.bounds[value][1]:
+            return False
+        unassigned = self.unassigned - (var not in assignment)
+        if unassigned == 0:
+            # Everything is assigned, now the minimums count too
+            for other, (low, _) in self.bounds.items():
+                if countOf(other) < low:
+                    return False
+        return True
+
+    def holding(self, value, assignment, var=None):
+        # Assigned variables in our scope that took value
+        return {other for other in self.scope if other != var and other in assignment and assignment[other] == value}
+
+    def culprits(self, var, value, assignment):
+        if value in self.bounds and self.counts[value] - (assignment.get(var) == value) >= self.bounds[value][1]:
+            # Too many already took value, they're the ones to blame
+            return self.holding(value, assignment, var)
+        return super().culprits(var, value, assignment)
+
+    def propagate(self, csp, assignment):
+        free = [var for var in self.scope if var not in assignment]
+        changed = []
+        # How many more of each value we still need
+        needed = 0
+        for value, (low, high) in self.bounds.items():
+            count = self.counts[value]
+            if count > high:
+                return None
+            needed += max(0, low - count)
+            holders = [var for var in free if csp.store.contains(var, value)]
+            if count == high:
+                # Full, nobody else can take this value
+                because = self.holding(value, assignment) if csp.backjumping else None
+                for var in holders:
+                    csp.prune(var, value, because)
+                    if csp.store.size(var) == 0:
+                        return None
+                    if var not in changed:
+                        changed.append(var)
+            elif count + len(holders) < low:
+                # Not enough variables left that could take it
+                return None
+            elif count + len(holders) == low:
+                # Every one of them has to take it
+                for var in holders:
+                    if csp.store.size(var) > 1:
+                        csp.force(var, value)
+                        if var not in changed:
+                            changed.append(var)
+        if needed > len(free):
+            # Can't reach every minimum with what is left
+            return None
+        if needed == len(free):
+            # Every free variable has to go to a value still under its minimum
+            short = [value for value, (low, _) in self.bounds.items() if self.counts[value] < low]
+            for var in free:
+                for value in list(csp.store.values(var)):
+                    if value not in short:
+                        csp.prune(var, value)
+                        if var not in changed:
+                            changed.append(var)
+                if csp.store.size(var) == 0:
+                    return None
+        return changed
+
+class SoftConstraint(Constraint):
+    # A constraint we would like to keep but can break at a cost.
+    # Solving ignores it, optimize() looks for the solution where
+    # the broken ones add up to the smallest total weight. Like the
+    # hard constraints, fn only judges var against variables that are
+    # already assigned, so each broken pair is only paid for once
+    def __init__(self, fn, scope=None, weight=1):
+        super().__init__(fn, scope)
+        self.weight = weight
+
+class Domains:
+    # Live domains for every variable, pruning is recorded on a
+    # trail so that we can roll it back when we backtrack
+    def __init__(self, variables, domains):
+        self.live = {var: list(domains[var]) for var in variables}
+        self.trail = []
+
+    def values(self, var):
+        return self.live[var]
+
+    def shuffled(self, var):
+        # Copy and then shuffle domains randomly,
+        # this keeps things fair and prevents
+        # us from getting stuck
+        values = list(self.live[var])
+        random.shuffle(values)
+        return values
+
+    def size(self, var):
+        return len(self.live[var])
+
+    def contains(self, var, value):
+        return value in self.live[var]
+
+    def remove(self, var, value):
+        self.trail.append((var, self.live[var]))
+        self.live[var] = [v for v in self.live[var] if v != value]
+
+    def assign(self, var, value):
+        self.trail.append((var, self.live[var]))
+        self.live[var] = [value]
+
+    def mark(self):
+        return len(self.trail)
+
+    def undo(self, mark):
+        while len(self.trail) > mark:
+            var, values = self.trail.pop()
+            self.live[var] = values
+
+class BitsetDomains:
+    # Same job as Domains, but every domain is an int bitmask over
+    # the positions of the variable's original values. Sizes are a
+    # popcount and the trail only has to remember the old masks
+    def __init__(self, variables, domains):
+        self.order = {}
+        self.position = {}
+        self.masks = {}
+        self.trail = []
+        # Variables very often share a domain, so only build
+        # the value <-> position tables once per domain
+        tables = {}
+        for var in variables:
+            domain = domains[var]
+            if id(domain) not in tables:
+                order = list(domain)
+                tables[id(domain)] = (order, {value: i for i, value in enumerate(order)})
+            self.order[var], self.position[var] = tables[id(domain)]
+            self.masks[var] = (1 << len(self.order[var])) - 1
+
+    def values(self, var):
+        # Walk the set bits of a snapshot of the mask,
+        # so it is safe to prune while iterating
+        mask = self.masks[var]
+        order = self.order[var]
+        while mask:
+            low = mask & -mask
+            yield order[low.bit_length() - 1]
+            mask ^= low
+
+    def shuffled(self, var):
+        # Start from a random position and wrap around instead
+        # of building and shuffling a list at every node
+        n = len(self.order[var])
+        if n == 0:
+            return
+        start = random.randrange(n)
+        mask = self.masks[var]
+        rotated = (mask >> start) | ((mask << (n - start)) & ((1 << n) - 1))
+        order = self.order[var]
+        while rotated:
+            low = rotated & -rotated
+            yield order[(low.bit_length() - 1 + start) % n]
+            rotated ^= low
+
+    def size(self, var):
+        return self.masks[var].bit_count()
+
+    def contains(self, var, value):
+        i = self.position[var].get(value)
+        return i is not None and self.masks[var] >> i & 1 == 1
+
+    def remove(self, var, value):
+        i = self.position[var].get(value)
+        if i is None or not self.masks[var] >> i & 1:
+            return
+        self.trail.append((var, self.masks[var]))
+        self.masks[var] &= ~(1 << i)
+
+    def assign(self, var, value):
+        self.trail.append((var, self.masks[var]))
+        self.masks[var] = 1 << self.position[var][value]
+
+    def mark(self):
+        return len(self.trail)
+
+    def undo(self, mark):
+        while len(self.trail) > mark:
+            var, mask = self.trail.pop()
+            self.masks[var] = mask
+
+class Restart(Exception):
+    # Raised from deep in the search once a run has used up its failures
+    pass
+
+def luby(i):
+    # i-th term of 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8, ...
+    k = 1
+    while True:
+        if i == (1 << k) - 1:
+            return 1 << (k - 1)
+        if (1 << (k - 1)) <= i < (1 << k) - 1:
+            i -= (1 << (k - 1)) - 1
+            k = 1
+        else:
+            k += 1
+
+# Settings each solveParallel worker cycles through,
+# None keeps whatever the CSP was built with
+PORTFOLIO = [None, "fc", "mac"]
+
+# Stands in for unassigned variables in cache keys
+UNASSIGNED = object()
+
+class Stats:
+    # Counters for the last solve, see CSP.stats
+    def __init__(self):
+        # Values assigned and values that failed, over every run
+        self.nodes = 0
+        self.backtracks = 0
+        self.restarts = 0
+        self.maxDepth = 0
+        # Seconds from the start until the first solution, and in total
+        self.firstSolution = None
+        self.elapsed = 0.0
+        # Only filled in with CSP(profile=True), constraint name ->
+        # how many times it ran and how many seconds that took
+        self.calls = {}
+        self.time = {}
+        # Only counted with CSP(cache_size=...), pure constraint
+        # checks answered from the cache and ones that ran
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.started = time.perf_counter()
+
+    def record(self, name, seconds):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.time[name] = self.time.get(name, 0.0) + seconds
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def hitRate(self):
+        lookups = self.cacheHits + self.cacheMisses
+        return self.cacheHits / lookups if lookups else 0.0
+
+    def __str__(self):
+        first = "-" if self.firstSolution is None else f"{self.firstSolution:.3f}s"
+        lines = [
+            f"{self.nodes} nodes, {self.backtracks} backtracks, {self.restarts} restarts, "
+            f"max depth {self.maxDepth}",
+            f"first solution after {first}, {self.elapsed:.3f}s in total",
+        ]
+        if self.cacheHits or self.cacheMisses:
+            lines.append(f"cache: {self.cacheHits} hits, {self.cacheMisses} misses, "
+                         f"{self.hitRate():.1%} hit rate")
+        # Most expensive constraints first
+        for name in sorted(self.time, key=self.time.get, reverse=True):
+            lines.append(f"  {name}: {self.calls[name]} calls, {self.time[name]:.3f}s")
+        return "\n".join(lines)
 
 class CSP:
-    def __init__(self, variables, domains, constraints=[]):
+    def __init__(self, variables, domains, constraints=[], inference=None, domain_store=Domains,
+                 restarts=None, restart_base=100, backjumping=False, engine="recursive",
+                 profile=False, progress=None, progress_every=10000,
+                 variable_order="mrv", value_order="random", cache_size=None):
         self.variables = variables
         self.domains = domains
-        self.constraints = constraints
+        # None - only check constraints against the current assignment
+        # "fc" - forward check the neighbours of every assigned variable
+        # "mac" - keep propagating until every domain is consistent
+        self.inference = inference
+        # Domains (lists) or BitsetDomains (int bitmasks)
+        self.domain_store = domain_store
+        # None, "luby" or "geometric" - give up on a run after
+        # restart_base failures times the schedule and start over
+        self.restarts = restarts
+        self.restart_base = restart_base
+        # Refuted partial assignments up to this many variables
+        # are remembered from one run to the next
+        self.max_nogood_size = 10
+        self.nogoods = None
+        self.failures = 0
+        self.failureLimit = None
+        # Jump straight back to the variable behind a failure
+        # instead of the most recent one
+        self.backjumping = backjumping
+        # Assigned variables in order, and why values left each domain
+        self.decisions = []
+        self.reasons = []
+        self.found = 0
+        # "recursive" - one Python frame per assigned variable
+        # "iterative" - levels kept on an explicit stack, for problems
+        #               with more variables than the recursion limit
+        self.engine = engine
+        # Time every constraint call, which slows the search down
+        self.profile = profile
+        # progress(stats) is called every progress_every nodes
+        self.progress = progress
+        self.progress_every = progress_every
+        # Which variable to try next
+        # "mrv" - smallest live domain, ties go to the one in most constraints
+        # "dom/deg" - smallest live domain per constraint it still shares
+        #             with an unassigned variable
+        # "dom/wdeg" - the same, but every constraint counts for one more
+        #              each time it fails, so trouble spots go first
+        # "static" - the order the variables were given in
+        self.variable_order = variable_order
+        # Which value to try first
+        # "random" - shuffled, restarts rely on this to try something new
+        # "lcv" - whichever rules out the fewest values of its neighbours,
+        #         ties in a random order
+        # "static" - the order of the domain
+        self.value_order = value_order
+        # Constraint -> failures + 1, for dom/wdeg
+        self.weights = {}
+        # Values to try first, see resolve()
+        self.preferred = None
+        # Remember the last cache_size results of pure constraints,
+        # keyed on the constraint, var, value and the scope's values.
+        # They can't go stale, so they are kept from one solve to the next
+        self.cache_size = cache_size
+        self.cache = OrderedDict() if cache_size else None
+        self.stats = Stats()
+        # Plain functions are still allowed, they just have no scope
+        constraints = [
+            c if isinstance(c, Constraint) else Constraint(c)
+            for c in constraints
+        ]
+        self.constraints = [c for c in constraints if not isinstance(c, SoftConstraint)]
+        self.soft = [c for c in constraints if isinstance(c, SoftConstraint)]
         self.solution = None
+        self.buildIndex()
+        self.store = self.domain_store(self.variables, self.domains)
+
+    def buildIndex(self):
+        # Map every variable to the constraints that can involve it,
+        # so we never call a constraint that is a no-op for that variable
+        unscoped = [c for c in self.constraints if c.scope is None]
+        self.index = {var: list(unscoped) for var in self.variables}
+        for constraint in self.constraints:
+            if constraint.scope is None:
+                continue
+            for var in constraint.scope:
+                if var in self.index:
+                    self.index[var].append(constraint)
+        # Soft constraints get their own index, only optimize() looks
+        self.softIndex = {var: [c for c in self.soft if c.scope is None] for var in self.variables}
+        for constraint in self.soft:
+            for var in constraint.scope or ():
+                if var in self.softIndex:
+                    self.softIndex[var].append(constraint)
+        # Scoped constraints each variable is in, MRV breaks ties with it
+        self.degree = {
+            var: sum(1 for c in self.index[var] if c.scope is not None)
+            for var in self.variables
+        }
+        # Every neighbour of a variable and the constraints they share, for LCV
+        if self.value_order == "lcv":
+            self.neighbours = {var: {} for var in self.variables}
+            for constraint in self.constraints:
+                for var in constraint.scope or ():
+                    if var not in self.neighbours:
+                        continue
+                    for other in constraint.scope:
+                        if other != var and other in self.neighbours:
+                            self.neighbours[var].setdefault(other, []).append(constraint)
+        # Only bother calling the hooks of constraints that use them
+        self.hooked = {
+            var: [c for c in self.index[var] + self.softIndex[var] if c.stateful()]
+            for var in self.variables
+        }
 
     def solve(self):
+        self.solution = None
+        self.nogoods = None if self.restarts is None else {}
+        self.weights = {}
+        self.stats = Stats()
+        self.solution = self.solveFrom({})
+        self.stats.stop()
+        return self.solution
+
+    def solveFrom(self, fixed):
+        # Search with restarts, with the variables in fixed
+        # held to their values in every run
+        run = 0
+        while True:
+            run += 1
+            assignment = {}
+            if not self.prepare(assignment) or not self.fix(fixed, assignment):
+                return None
+            if self.restarts is not None:
+                self.failureLimit = self.restart_base * self.restartScale(run)
+            try:
+                return self.backtrack(assignment)
+            except Restart:
+                # prepare() puts every domain and constraint back
+                self.stats.restarts += 1
+                continue
+
+    def fix(self, fixed, assignment):
+        for var, value in fixed.items():
+            if not self.store.contains(var, value) or not self.checkConstraints(var, value, assignment):
+                return False
+            self.assign(var, value, assignment)
+            if self.inference is not None and not self.propagate(self.index[var], assignment):
+                return False
+        return True
+
+    def resolve(self, previous, add=(), remove=(), domains=None):
+        # Repair an earlier solution after the problem changed, instead
+        # of starting again from nothing. add and remove are constraints,
+        # domains maps variables to their new values. Only the variables
+        # whose values no longer work are searched at first, everything
+        # else keeps its old value. If that fails the search widens to
+        # their neighbours, doubling each time, and values from previous
+        # are always tried first
+        removed = [c for c in self.constraints + self.soft if c in remove or c.fn in remove]
+        # Nogoods hold for as long as the problem only gets tighter
+        tighter = not removed and all(
+            set(values) <= set(self.domains[var]) for var, values in (domains or {}).items()
+        )
+        added = [c if isinstance(c, Constraint) else Constraint(c) for c in add]
+        self.constraints = [c for c in self.constraints if c not in removed]
+        self.constraints += [c for c in added if not isinstance(c, SoftConstraint)]
+        self.soft = [c for c in self.soft if c not in removed]
+        self.soft += [c for c in added if isinstance(c, SoftConstraint)]
+        if domains:
+            self.domains = {**self.domains, **domains}
+        self.buildIndex()
+        if not tighter or self.nogoods is None:
+            self.nogoods = {}
+
+        self.stats = Stats()
+        self.solution = None
+        self.preferred = previous
+        try:
+            free = self.broken(previous)
+            while True:
+                fixed = {var: previous[var] for var in self.variables if var not in free}
+                self.solution = self.solveFrom(fixed)
+                if self.solution is not None or not fixed:
+                    break
+                free = self.widen(free)
+        finally:
+            self.preferred = None
+        self.stats.stop()
+        return self.solution
+
+    def broken(self, previous):
+        # Variables of previous that break the constraints as they are now,
+        # or whose value is gone from their domain
         assignment = {}
-        self.solution = self.backtrack(assignment)
+        self.prepare(assignment)
+        for var in self.variables:
+            if var in previous and self.store.contains(var, previous[var]):
+                assignment[var] = previous[var]
+                for constraint in self.hooked[var]:
+                    constraint.onAssign(var, previous[var])
+        return {
+            var for var in self.variables
+            if var not in assignment or not self.checkConstraints(var, assignment[var], assignment)
+        }
+
+    def widen(self, free):
+        # Twice as many variables as free, adding the nearest ones
+        # through the constraints with the smallest scopes first
+        free = set(free)
+        queue = list(free) or list(self.variables[:1])
+        target = max(2 * len(free), 1)
+        while queue and len(free) < target:
+            var = queue.pop(0)
+            for constraint in sorted(self.index[var], key=lambda c: len(c.scope or self.variables)):
+                for other in constraint.scope or self.variables:
+                    if other not in free and other in self.index:
+                        free.add(other)
+                        queue.append(other)
+                        if len(free) >= target:
+                            return free
+        if len(free) < target:
+            # Nothing left that is connected, take whatever is next
+            free.update([var for var in self.variables if var not in free][:target - len(free)])
+        return free
+
+    def restartScale(self, run):
+        if self.restarts == "luby":
+            return luby(run)
+        if self.restarts == "geometric":
+            return 1.5 ** (run - 1)
+        raise ValueError(f"Unknown restart schedule: {self.restarts}")
+
+    def solveParallel(self, workers=None, seed=None):
+        # Race differently seeded and configured copies of the solver in
+        # separate processes, take whichever finishes first and stop the
+        # rest. Random value ordering makes single runs heavy tailed, a
+        # handful of them side by side is much more predictable
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        # Forking shares the model with the workers, so closures as
+        # constraints are fine. Elsewhere the CSP has to pickle
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        seeds = random.Random(seed).sample(range(2**32), workers)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=self.portfolioWorker,
+                args=(seeds[i], PORTFOLIO[i % len(PORTFOLIO)] or self.inference, results),
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        self.solution = None
+        errors = []
+        try:
+            for _ in processes:
+                solution, stats, error = results.get()
+                if error is not None:
+                    errors.append(error)
+                    continue
+                # Every worker is complete, so one of them coming back
+                # empty handed means there is no solution at all
+                self.solution = solution
+                self.stats = stats
+                break
+            else:
+                raise RuntimeError(f"Every solver process failed: {errors[0]}")
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
         return self.solution
 
+    def portfolioWorker(self, seed, inference, results):
+        try:
+            random.seed(seed)
+            self.inference = inference
+            solution = self.solve()
+            results.put((solution, self.stats, None))
+        except Exception as e:
+            results.put((None, None, repr(e)))
+
+    def iterSolutions(self):
+        # Every solution, one at a time, without holding on to them
+        assignment = {}
+        self.nogoods = None
+        self.stats = Stats()
+        if self.prepare(assignment):
+            for solution in self.search(assignment):
+                yield dict(solution)
+        self.stats.stop()
+
+    def countSolutions(self):
+        assignment = {}
+        self.nogoods = None
+        self.stats = Stats()
+        if not self.prepare(assignment):
+            total = 0
+        elif any(c.scope is None for c in self.constraints):
+            # Without scopes we can't tell what is independent,
+            # so just count them one by one
+            total = sum(1 for _ in self.search(assignment))
+        else:
+            self.countCache = {}
+            total = self.countRest(assignment, list(self.variables))
+        self.stats.stop()
+        return total
+
+    def minConflicts(self, max_steps=100000, tabu=10, walk=0.02):
+        # Local search instead of backtracking: start from a complete
+        # assignment and keep changing the value of a variable that
+        # breaks a constraint until none do. Much faster on large loose
+        # problems, but it can't prove there is no solution, it just
+        # gives up with None after max_steps moves
+        self.stats = Stats()
+        for constraint in self.constraints + self.soft:
+            constraint.reset()
+        domains = {var: list(self.domains[var]) for var in self.variables}
+        if not all(domains.values()):
+            # Nothing to start from, and no move could ever fix it
+            self.stats.stop()
+            self.solution = None
+            return None
+        # Unscoped constraints could involve anyone
+        scopes = {
+            constraint: self.variables if constraint.scope is None else
+            [var for var in constraint.scope if var in self.index]
+            for constraint in self.constraints
+        }
+
+        # Greedy start - give every variable a value that works with
+        # the ones before it, or any value at all if there isn't one
+        assignment = {}
+        for var in self.variables:
+            values = [value for value in domains[var] if self.checkConstraints(var, value, assignment)]
+            self.relabel(var, random.choice(values or domains[var]), assignment)
+
+        # Which constraints each variable currently breaks. A verdict
+        # can only change when something in the constraint's scope
+        # does, so a move only rechecks the constraints of the moved
+        # variable, and only for the variables in their scopes
+        broken = {var: set() for var in self.variables}
+        conflicted = set()
+
+        def recheck(constraint):
+            for var in scopes[constraint]:
+                if constraint(var, assignment[var], assignment):
+                    broken[var].discard(constraint)
+                    if not broken[var]:
+                        conflicted.discard(var)
+                else:
+                    broken[var].add(constraint)
+                    conflicted.add(var)
+
+        for constraint in self.constraints:
+            recheck(constraint)
+
+        # (var, value) -> the step until which var can't go back to value,
+        # so we don't undo the last few moves straight away
+        tabuUntil = {}
+        for step in range(max_steps):
+            if not conflicted:
+                self.stats.stop()
+                self.solution = dict(assignment)
+                return self.solution
+            var = random.choice(list(conflicted))
+            current = assignment[var]
+            if random.random() < walk:
+                # Random walk, to get off plateaus
+                choices = [value for value in domains[var] if value != current] or [current]
+            else:
+                choices, fewest = [], None
+                for value in domains[var]:
+                    conflicts = sum(1 for c in self.index[var] if not c(var, value, assignment))
+                    if tabuUntil.get((var, value), -1) > step and conflicts:
+                        # Tabu, unless it would fix var completely
+                        continue
+                    if fewest is None or conflicts < fewest:
+                        choices, fewest = [value], conflicts
+                    elif conflicts == fewest:
+                        choices.append(value)
+                if not choices:
+                    continue
+            value = random.choice(choices)
+            if value == current:
+                continue
+            tabuUntil[(var, current)] = step + tabu
+            self.relabel(var, value, assignment)
+            for constraint in self.index[var]:
+                recheck(constraint)
+        self.stats.stop()
+        self.solution = None
+        return None
+
+    def relabel(self, var, value, assignment):
+        # Change the value of var outright, keeping stateful
+        # constraints up to date. Only local search needs this
+        hooked = self.hooked[var]
+        if var in assignment:
+            for constraint in hooked:
+                constraint.onUnassign(var, assignment[var])
+        assignment[var] = value
+        for constraint in hooked:
+            constraint.onAssign(var, value)
+        self.stats.nodes += 1
+
+    def optimize(self, timeout=None):
+        # Branch and bound over the soft constraints. Yields (cost,
+        # solution) every time it finds a solution cheaper than the
+        # last, so whatever it has is usable at any point. Stop it by
+        # no longer asking for more, or give it a timeout in seconds.
+        # When it runs out on its own the last solution was the best
+        self.stats = Stats()
+        self.nogoods = None
+        self.best = None
+        self.deadline = None if timeout is None else time.perf_counter() + timeout
+        assignment = {}
+        if self.prepare(assignment):
+            for cost in self.branch(assignment, 0):
+                yield cost, dict(assignment)
+        self.stats.stop()
+
+    def branch(self, assignment, cost):
+        # Yields the cost of every solution below here that beats
+        # the best so far, cost is what the assigned variables broke
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            return
+        if len(assignment) == len(self.variables):
+            if self.finalCheck(assignment):
+                self.best = cost
+                self.foundOne()
+                yield cost
+            return
+
+        var = self.findUnassignedVar(assignment)
+        # Cheapest values first, the sooner we find a good solution
+        # the more of the rest we can skip
+        options = [
+            (self.cost(var, value, assignment), value)
+            for value in self.getDomainVals(var, assignment)
+            if self.checkConstraints(var, value, assignment)
+        ]
+        options.sort(key=lambda option: option[0])
+        for extra, value in options:
+            if self.best is not None and cost + extra >= self.best:
+                # Sorted, so every other value is at least as bad
+                break
+            mark = self.store.mark()
+            self.assign(var, value, assignment)
+            if (
+                (self.inference is None or self.propagate(self.index[var], assignment))
+                and (self.best is None or cost + extra + self.lowerBound(assignment) < self.best)
+            ):
+                yield from self.branch(assignment, cost + extra)
+            else:
+                self.stats.backtracks += 1
+            self.store.undo(mark)
+            self.unassign(var, assignment)
+
+    def cost(self, var, value, assignment):
+        # What setting var to value breaks, given what is assigned
+        return sum(c.weight for c in self.softIndex[var] if not c(var, value, assignment))
+
+    def lowerBound(self, assignment):
+        # Every unassigned variable will cost at least as much as its
+        # cheapest value does now, assigning more only breaks more
+        bound = 0
+        for var in self.variables:
+            if var not in assignment and self.softIndex[var]:
+                bound += min(
+                    (self.cost(var, value, assignment) for value in self.store.values(var)),
+                    default=0,
+                )
+        return bound
+
+    def prepare(self, assignment):
+        # Fresh domains and constraint state before every search
+        self.store = self.domain_store(self.variables, self.domains)
+        self.failures = 0
+        self.failureLimit = None
+        self.decisions = []
+        self.reasons = []
+        for constraint in self.constraints + self.soft:
+            constraint.reset()
+        if self.inference == "mac":
+            # Make everything arc consistent before we start guessing
+            return self.propagate(self.constraints, assignment)
+        return True
+
     def backtrack(self, assignment):
+        # First solution below this assignment, or None
+        for solution in self.search(assignment):
+            return solution
+        return None
+
+    def search(self, assignment):
+        # Yields every solution below this assignment. When there are
+        # none and backjumping is on, returns the variables to blame
+        if self.engine == "recursive":
+            return self.searchRecursive(assignment)
+        if self.engine == "iterative":
+            return self.searchIterative(assignment)
+        raise ValueError(f"Unknown search engine: {self.engine}")
+
+    def searchRecursive(self, assignment):
         # Base case - no unnasigned variables left
         if len(assignment) == len(self.variables):
-            # Run constraint checks one last time
-            for var in self.variables:
-                if not self.checkConstraints(var, assignment[var], assignment):
-                    return None
-            return assignment
+            if not self.finalCheck(assignment):
+                return self.conflict if self.backjumping else None
+            self.found += 1
+            self.foundOne()
+            yield assignment
+            return None
 
         var = self.findUnassignedVar(assignment)
+        # Everything that ruled out a value of var
+        conflict = set() if self.backjumping else None
         for value in self.getDomainVals(var, assignment):
-            if self.checkConstraints(var, value, assignment):
-                assignment[var] = value
-                result = self.backtrack(assignment)
-                if result is not None:
-                    return result
-                del assignment[var]
+            if not self.checkConstraints(var, value, assignment):
+                if conflict is not None:
+                    conflict |= self.blame(var, value, assignment)
+                self.fail()
+                continue
+            nogood = self.isNogood(var, value, assignment)
+            if nogood is not None:
+                if conflict is not None:
+                    conflict.update(other for other, _ in nogood if other != var)
+                self.fail()
+                continue
+            mark = self.store.mark()
+            reasonMark = len(self.reasons)
+            self.assign(var, value, assignment)
+            found = self.found
+            below = None
+            if self.inference is None or self.propagate(self.index[var], assignment):
+                below = yield from self.searchRecursive(assignment)
+            elif self.backjumping:
+                below = self.conflict
+            found = self.found > found
+            if not found:
+                # Nothing below here works, remember that for later runs
+                self.learn(assignment, below)
+            # Put back everything we pruned below this point
+            self.store.undo(mark)
+            del self.reasons[reasonMark:]
+            self.unassign(var, assignment)
+            if below is None or found:
+                # Can't say what went wrong, fall back to chronological
+                conflict = None
+            elif var not in below:
+                # var had nothing to do with it, so none of its other
+                # values can help either. Hand it straight up
+                return below
+            elif conflict is not None:
+                conflict |= below
+            if not found:
+                self.fail()
+        if conflict is None:
+            return None
+        # Whoever pruned var's domain is to blame as well
+        conflict |= self.reasonsFor(var)
+        conflict.discard(var)
+        return conflict
+
+    def searchIterative(self, assignment):
+        # The same search as searchRecursive, except that every level
+        # is a small list on a stack instead of a Python frame:
+        # [var, values left to try, conflict, mark, reasonMark, found]
+        # mark is None until a value of var has been assigned
+        stack = []
+        descend = True
+        while True:
+            if descend:
+                descend = False
+                if len(assignment) == len(self.variables):
+                    # Base case - no unnasigned variables left
+                    if self.finalCheck(assignment):
+                        self.found += 1
+                        self.foundOne()
+                        yield assignment
+                        below = None
+                    else:
+                        below = self.conflict if self.backjumping else None
+                    if not stack:
+                        return below
+                else:
+                    var = self.findUnassignedVar(assignment)
+                    conflict = set() if self.backjumping else None
+                    stack.append([var, iter(self.getDomainVals(var, assignment)), conflict, None, 0, 0])
+
+            level = stack[-1]
+            var, values, conflict, mark, reasonMark, found = level
+            if mark is not None:
+                # Back from the value we were trying, below says why it failed
+                level[3] = None
+                found = self.found > found
+                if not found:
+                    self.learn(assignment, below)
+                self.store.undo(mark)
+                del self.reasons[reasonMark:]
+                self.unassign(var, assignment)
+                if below is None or found:
+                    conflict = level[2] = None
+                elif var not in below:
+                    # Jump straight over this level
+                    stack.pop()
+                    if not stack:
+                        return below
+                    continue
+                elif conflict is not None:
+                    conflict |= below
+                if not found:
+                    self.fail()
+
+            for value in values:
+                if not self.checkConstraints(var, value, assignment):
+                    if conflict is not None:
+                        conflict |= self.blame(var, value, assignment)
+                    self.fail()
+                    continue
+                nogood = self.isNogood(var, value, assignment)
+                if nogood is not None:
+                    if conflict is not None:
+                        conflict.update(other for other, _ in nogood if other != var)
+                    self.fail()
+                    continue
+                level[3] = self.store.mark()
+                level[4] = len(self.reasons)
+                level[5] = self.found
+                self.assign(var, value, assignment)
+                if self.inference is None or self.propagate(self.index[var], assignment):
+                    descend = True
+                else:
+                    below = self.conflict if self.backjumping else None
+                break
+            else:
+                # Out of values, hand the conflict to the level below
+                stack.pop()
+                below = None
+                if conflict is not None:
+                    conflict |= self.reasonsFor(var)
+                    conflict.discard(var)
+                    below = conflict
+                if not stack:
+                    return below
+
+    def foundOne(self):
+        if self.stats.firstSolution is None:
+            self.stats.firstSolution = time.perf_counter() - self.stats.started
+
+    def finalCheck(self, assignment):
+        # Run constraint checks one last time
+        for var in self.variables:
+            if not self.checkConstraints(var, assignment[var], assignment):
+                if self.backjumping:
+                    self.conflict = self.blame(var, assignment[var], assignment) | {var}
+                return False
+        return True
+
+    def blame(self, var, value, assignment):
+        return self.failed.culprits(var, value, assignment)
+
+    def prune(self, var, value, because=None):
+        # Take value out of var's domain. because is the set of assigned
+        # variables that did it, None means everything assigned so far
+        self.store.remove(var, value)
+        if self.backjumping:
+            self.reasons.append((var, len(self.decisions) if because is None else because))
+
+    def force(self, var, value, because=None):
+        # Like prune, but throws out everything except value
+        self.store.assign(var, value)
+        if self.backjumping:
+            self.reasons.append((var, len(self.decisions) if because is None else because))
+
+    def reasonsFor(self, var):
+        culprits = set()
+        for other, because in self.reasons:
+            if other != var:
+                continue
+            if isinstance(because, int):
+                culprits.update(self.decisions[:because])
+            else:
+                culprits |= because
+        return culprits
+
+    def fail(self):
+        self.failures += 1
+        self.stats.backtracks += 1
+        if self.failureLimit is not None and self.failures > self.failureLimit:
+            raise Restart()
+
+    def learn(self, assignment, culprits=None):
+        # With backjumping only the culprits matter, which
+        # makes for much smaller and more useful nogoods
+        if self.nogoods is None:
+            return
+        if culprits is None:
+            culprits = assignment
+        if len(culprits) > self.max_nogood_size:
+            return
+        nogood = tuple((var, assignment[var]) for var in culprits)
+        for literal in nogood:
+            self.nogoods.setdefault(literal, []).append(nogood)
+
+    def isNogood(self, var, value, assignment):
+        # The recorded nogood that var = value would complete, if any
+        if not self.nogoods:
+            return None
+        for nogood in self.nogoods.get((var, value), ()):
+            if all(
+                other == var or (other in assignment and assignment[other] == otherValue)
+                for other, otherValue in nogood
+            ):
+                return nogood
         return None
 
+    def countPart(self, assignment, part):
+        # Number of ways to finish a connected group of unassigned
+        # variables. It only depends on their live domains and the
+        # values of the assigned variables they share constraints with,
+        # so the same situation is only ever counted once
+        boundary = set()
+        for var in part:
+            for constraint in self.index[var]:
+                left = [other for other in constraint.scope if other not in assignment]
+                if len(left) == 1 and self.inference is not None and type(constraint) is Constraint:
+                    # Propagation already took the assigned values
+                    # out of the last variable's domain
+                    continue
+                boundary.update(other for other in constraint.scope if other in assignment)
+        key = (
+            frozenset((var, frozenset(self.store.values(var))) for var in part),
+            frozenset((var, assignment[var]) for var in boundary),
+        )
+        if key not in self.countCache:
+            self.countCache[key] = self.countBranch(assignment, part)
+        return self.countCache[key]
+
+    def countBranch(self, assignment, part):
+        var = min(part, key=lambda var: self.store.size(var))
+        rest = [other for other in part if other != var]
+        total = 0
+        for value in list(self.store.values(var)):
+            if self.checkConstraints(var, value, assignment):
+                mark = self.store.mark()
+                self.assign(var, value, assignment)
+                if self.inference is None or self.propagate(self.index[var], assignment):
+                    # Constraints that only judge a finished assignment
+                    # get their last look from their last variable
+                    if self.checkConstraints(var, value, assignment):
+                        total += self.countRest(assignment, rest)
+                self.store.undo(mark)
+                self.unassign(var, assignment)
+        return total
+
+    def countRest(self, assignment, rest):
+        # Independent groups multiply together
+        total = 1
+        for part in self.split(rest):
+            total *= self.countPart(assignment, part)
+            if total == 0:
+                break
+        return total
+
+    def split(self, free):
+        # Groups of unassigned variables that share no constraint
+        free = set(free)
+        parts = []
+        while free:
+            start = free.pop()
+            part = [start]
+            queue = [start]
+            while queue:
+                var = queue.pop()
+                for constraint in self.index[var]:
+                    for other in constraint.scope:
+                        if other in free:
+                            free.discard(other)
+                            part.append(other)
+                            queue.append(other)
+            parts.append(part)
+        return parts
+
+    def assign(self, var, value, assignment):
+        assignment[var] = value
+        self.decisions.append(var)
+        stats = self.stats
+        stats.nodes += 1
+        if len(assignment) > stats.maxDepth:
+            stats.maxDepth = len(assignment)
+        if self.progress is not None and stats.nodes % self.progress_every == 0:
+            self.progress(stats)
+        self.store.assign(var, value)
+        for constraint in self.hooked[var]:
+            constraint.onAssign(var, value)
+
+    def unassign(self, var, assignment):
+        value = assignment.pop(var)
+        self.decisions.pop()
+        for constraint in self.hooked[var]:
+            constraint.onUnassign(var, value)
+
+    def propagate(self, constraints, assignment):
+        queue = [c for c in constraints if c.scope is not None]
+        queued = set(queue)
+        while queue:
+            constraint = queue.pop()
+            queued.discard(constraint)
+            if self.profile:
+                start = time.perf_counter()
+                changed = constraint.propagate(self, assignment)
+                self.stats.record(constraint.name + " (propagate)", time.perf_counter() - start)
+            else:
+                changed = constraint.propagate(self, assignment)
+            if changed is None:
+                # Some variable has no values left
+                self.weigh(constraint)
+                if self.backjumping:
+                    self.conflict = self.wipeoutConflict(constraint, assignment)
+                return False
+            if self.inference != "mac":
+                continue
+            # Anything that shares a shrunken variable needs another look
+            for var in changed:
+                for other in self.index[var]:
+                    if other.scope is not None and other not in queued:
+                        queue.append(other)
+                        queued.add(other)
+        return True
+
+    def wipeoutConflict(self, constraint, assignment):
+        for var in constraint.scope:
+            if var not in assignment and self.store.size(var) == 0:
+                # Whatever emptied it is to blame
+                return self.reasonsFor(var)
+        # The constraint gave up without emptying anything
+        return set(assignment)
+
     def findUnassignedVar(self, assignment):
         unassigned_vars = [var for var in self.variables if var not in assignment]
 
-        # Find whichever unassigned var has the smallest domain
-        return min(unassigned_vars, key=lambda var: len(self.domains[var]))
+        if self.variable_order == "mrv":
+            # Find whichever unassigned var has the smallest live domain
+            return min(unassigned_vars, key=lambda var: (self.store.size(var), -self.degree[var]))
+        if self.variable_order == "dom/deg":
+            return min(unassigned_vars, key=lambda var: self.store.size(var) / self.futureWeight(var, assignment, False))
+        if self.variable_order == "dom/wdeg":
+            return min(unassigned_vars, key=lambda var: self.store.size(var) / self.futureWeight(var, assignment, True))
+        if self.variable_order == "static":
+            return unassigned_vars[0]
+        raise ValueError(f"Unknown variable order: {self.variable_order}")
+
+    def futureWeight(self, var, assignment, weighted):
+        # How many constraints var shares with another unassigned variable,
+        # or how often those failed. Never 0, so we can divide by it
+        total = 0
+        for constraint in self.index[var]:
+            if constraint.scope is not None and not any(
+                other != var and other not in assignment for other in constraint.scope
+            ):
+                continue
+            total += self.weights.get(constraint, 1) if weighted else 1
+        return total or 0.5
+
+    def weigh(self, constraint):
+        if self.variable_order == "dom/wdeg":
+            self.weights[constraint] = self.weights.get(constraint, 1) + 1
 
     def getDomainVals(self, var, assignment):
-        # Copy and then shuffle domains randomly,
-        # this keeps things fair and prevents
-        # us from getting stuck
-        domains = list(self.domains[var])
-        random.shuffle(domains)
-        return domains
+        values = self.orderValues(var, assignment)
+        if self.preferred is not None and var in self.preferred:
+            # Keep what it had before if we can
+            values = list(values)
+            value = self.preferred[var]
+            if value in values:
+                values.remove(value)
+                values.insert(0, value)
+        return values
+
+    def orderValues(self, var, assignment):
+        if self.value_order == "random":
+            # Live values in a random order, the store
+            # decides how to do that cheaply
+            return self.store.shuffled(var)
+        if self.value_order == "lcv":
+            return self.leastConstraining(var, assignment)
+        if self.value_order == "static":
+            return self.store.values(var)
+        raise ValueError(f"Unknown value order: {self.value_order}")
+
+    def leastConstraining(self, var, assignment):
+        # Try each value out, hooks and all, and count how many values
+        # of the unassigned neighbours it would rule out. Constraints
+        # without a scope could touch anything, so they don't count
+        neighbours = [
+            (other, constraints) for other, constraints in self.neighbours[var].items()
+            if other not in assignment
+        ]
+        ruledOut = {}
+        # Shuffled first, so ties still come out differently after a restart
+        values = list(self.store.shuffled(var))
+        for value in values:
+            assignment[var] = value
+            for constraint in self.hooked[var]:
+                constraint.onAssign(var, value)
+            count = 0
+            for other, constraints in neighbours:
+                for otherValue in self.store.values(other):
+                    if not all(c(other, otherValue, assignment) for c in constraints):
+                        count += 1
+            for constraint in self.hooked[var]:
+                constraint.onUnassign(var, value)
+            del assignment[var]
+            ruledOut[value] = count
+        return sorted(values, key=ruledOut.get)
 
     def checkConstraints(self, var, value, assignment):
-        for constraintFn in self.constraints:
+        if self.profile:
+            return self.checkConstraintsTimed(var, value, assignment)
+        if self.cache is not None:
+            return self.checkConstraintsCached(var, value, assignment)
+        for constraintFn in self.index[var]:
             if not constraintFn(var, value, assignment):
+                # Remember who said no, backjumping needs to know
+                self.failed = constraintFn
+                self.weigh(constraintFn)
+                return False
+        return True
+
+    def checkConstraintsCached(self, var, value, assignment):
+        # checkConstraints, looking pure constraints up in the cache first
+        for constraintFn in self.index[var]:
+            if constraintFn.pure:
+                ok = self.cached(constraintFn, var, value, assignment)
+            else:
+                ok = constraintFn(var, value, assignment)
+            if not ok:
+                self.failed = constraintFn
+                self.weigh(constraintFn)
+                return False
+        return True
+
+    def cached(self, constraint, var, value, assignment):
+        key = (constraint, var, value, tuple([assignment.get(other, UNASSIGNED) for other in constraint.scope]))
+        cache = self.cache
+        ok = cache.get(key)
+        if ok is not None:
+            cache.move_to_end(key)
+            self.stats.cacheHits += 1
+            return ok
+        self.stats.cacheMisses += 1
+        ok = bool(constraint(var, value, assignment))
+        cache[key] = ok
+        if len(cache) > self.cache_size:
+            # Least recently used goes first
+            cache.popitem(last=False)
+        return ok
+
+    def checkConstraintsTimed(self, var, value, assignment):
+        # checkConstraints, keeping track of where the time goes. Cache
+        # lookups are timed too, so the profile shows what they save
+        cache = self.cache
+        for constraintFn in self.index[var]:
+            start = time.perf_counter()
+            if cache is not None and constraintFn.pure:
+                ok = self.cached(constraintFn, var, value, assignment)
+            else:
+                ok = constraintFn(var, value, assignment)
+            self.stats.record(constraintFn.name, time.perf_counter() - start)
+            if not ok:
+                self.failed = constraintFn
+                self.weigh(constraintFn)
                 return False
         return True
@@ -0,0 +1,238 @@
+import random
+import sys
+import time
+
+from csp import CSP, Constraint, BitsetDomains
+
+# N-Queens with one variable per row, its value is the column of the
+# queen in that row. Rows can never clash, so only columns and the two
+# diagonals need checking, and those are kept as occupancy counts that
+# are updated as queens are placed and removed instead of scanned
+
+
+def printBoard(columns):
+    print("Board:")
+    print()
+    for column in columns:
+        print("." * column + "Q" + "." * (len(columns) - column - 1))
+    print()
+
+
+class NQueensConstraint(Constraint):
+    def __init__(self, n):
+        super().__init__(self.check, range(n))
+        self.n = n
+        self.reset()
+
+    def reset(self):
+        n = self.n
+        self.columns = [0] * n
+        # ↘ diagonals have a constant row - column, ↗ a constant row + column
+        self.downDiagonals = [0] * (2 * n - 1)
+        self.upDiagonals = [0] * (2 * n - 1)
+        # The queen placed most recently, propagate only has to look at it
+        self.last = None
+
+    def update(self, row, column, step):
+        self.columns[column] += step
+        self.downDiagonals[row - column + self.n - 1] += step
+        self.upDiagonals[row + column] += step
+
+    def onAssign(self, var, value):
+        self.update(var, value, 1)
+        self.last = (var, value)
+
+    def onUnassign(self, var, value):
+        self.update(var, value, -1)
+        self.last = None
+
+    def check(self, var, value, assignment):
+        # var's own queen doesn't count against it
+        mine = 1 if assignment.get(var) == value else 0
+        return (
+            self.columns[value] == mine
+            and self.downDiagonals[var - value + self.n - 1] == mine
+            and self.upDiagonals[var + value] == mine
+        )
+
+    def culprits(self, var, value, assignment):
+        # Only the queens on the same column or diagonals
+        return {
+            row for row, column in assignment.items()
+            if row != var and (column == value or abs(column - value) == abs(row - var))
+        }
+
+    def propagate(self, csp, assignment):
+        # Every queen placed before the last one already pruned the
+        # squares it attacks, so only the last one has work left
+        if self.last is None:
+            return []
+        row, column = self.last
+        because = {row} if csp.backjumping else None
+        changed = []
+        for other in range(self.n):
+            if other in assignment:
+                continue
+            distance = abs(other - row)
+            for attacked in (column, column - distance, column + distance):
+                if 0 <= attacked < self.n and csp.store.contains(other, attacked):
+                    csp.prune(other, attacked, because)
+                    if other not in changed:
+                        changed.append(other)
+            if csp.store.size(other) == 0:
+                return None
+        return changed
+
+
+def queensCSP(n, **options):
+    # Complete search, options go straight to CSP
+    variables = list(range(n))
+    domains = {row: list(range(n)) for row in variables}
+    # Every queen prunes a few values from every other row, which
+    # bitmasks handle far better than rebuilding lists
+    options.setdefault("inference", "fc")
+    options.setdefault("domain_store", BitsetDomains)
+    # Random value order makes some runs much longer than others
+    options.setdefault("restarts", "luby")
+    return CSP(variables, domains, [NQueensConstraint(n)], **options)
+
+
+def minConflicts(n, seed=None, max_steps=None):
+    # Local search for a single board, fast enough for millions of
+    # queens. Columns are kept a permutation so only diagonals can
+    # clash, and moves swap the columns of two rows. Returns the
+    # column of each row's queen, or None after max_steps swaps
+    rng = random.Random(seed)
+    rand = rng.random
+    if n in (2, 3):
+        return None
+    if max_steps is None:
+        max_steps = 100 * n + 10000
+    # Small boards have few solutions and get stuck easily,
+    # so every so often throw the board away and start again
+    patience = 10 * n + 100
+    offset = n - 1
+    steps = 0
+    while steps <= max_steps:
+        columns = list(range(n))
+        down = [0] * (2 * n - 1)
+        up = [0] * (2 * n - 1)
+
+        # Greedy start - fill the rows in order, trying a few random
+        # columns from the ones left for one whose diagonals are still
+        # empty. Only a handful of queens near the bottom end up attacked
+        attacked = []
+        for row in range(n):
+            left = n - row
+            for _ in range(32):
+                pick = row + int(rand() * left)
+                column = columns[pick]
+                if not down[row - column + offset] and not up[row + column]:
+                    break
+            else:
+                attacked.append(row)
+            columns[row], columns[pick] = column, columns[row]
+            down[row - column + offset] += 1
+            up[row + column] += 1
+
+        def clashes(row):
+            column = columns[row]
+            return down[row - column + offset] + up[row + column] - 2
+
+        def move(row, column, step):
+            # Add or take away a queen, returns the change in clashing pairs
+            d, u = row - column + offset, row + column
+            if step < 0:
+                down[d] -= 1
+                up[u] -= 1
+                return -(down[d] + up[u])
+            change = down[d] + up[u]
+            down[d] += 1
+            up[u] += 1
+            return change
+
+        def swap(a, b):
+            # Move the queens of rows a and b into each other's columns
+            ca, cb = columns[a], columns[b]
+            columns[a], columns[b] = cb, ca
+            return move(a, ca, -1) + move(b, cb, -1) + move(a, cb, 1) + move(b, ca, 1)
+
+        # Repair - swap an attacked queen with random others until it
+        # stops being attacked, undoing swaps that don't help. Anything
+        # attacked is always in the attacked list, since a swap only
+        # adds clashes to the two queens it moved
+        for _ in range(patience):
+            attacked = [row for row in attacked if clashes(row)]
+            if not attacked:
+                return columns
+            row = attacked[int(rand() * len(attacked))]
+            other = int(rand() * n)
+            if other == row:
+                continue
+            if swap(row, other) < 0:
+                if clashes(other):
+                    attacked.append(other)
+            else:
+                swap(row, other)
+        steps += patience
+    return None
+
+
+def isSolution(columns):
+    n = len(columns)
+    return (
+        len(set(columns)) == n
+        and len({row - column for row, column in enumerate(columns)}) == n
+        and len({row + column for row, column in enumerate(columns)}) == n
+    )
+
+
+def benchmark():
+    # The 64 cell model from queens.py against the one variable per
+    # row model, then local search on boards far too big for either
+    import queens
+
+    def timed(fn):
+        start = time.perf_counter()
+        result = fn()
+        return result, time.perf_counter() - start
+
+    print("*" * 7, "8 queens, first solution", "*" * 7)
+    old = CSP(queens.variables, queens.domains, [queens.QueensConstraint()], inference="fc")
+    _, seconds = timed(old.solve)
+    print(f"cells (queens.py): {seconds:.4f}s, {old.stats.nodes} nodes")
+    new = queensCSP(8)
+    _, seconds = timed(new.solve)
+    print(f"rows:              {seconds:.4f}s, {new.stats.nodes} nodes")
+
+    print("*" * 7, "8 queens, all solutions", "*" * 7)
+    count, seconds = timed(old.countSolutions)
+    print(f"cells (queens.py): {count} in {seconds:.4f}s")
+    count, seconds = timed(new.countSolutions)
+    print(f"rows:              {count} in {seconds:.4f}s")
+
+    print("*" * 7, "Backtracking on one variable per row", "*" * 7)
+    for n in (16, 32, 64, 128):
+        csp = queensCSP(n, engine="iterative")
+        columns, seconds = timed(csp.solve)
+        ok = columns is not None and isSolution([columns[row] for row in range(n)])
+        print(f"n={n}: {seconds:.3f}s, {csp.stats.backtracks} backtracks, valid={ok}")
+
+    print("*" * 7, "Min-conflicts", "*" * 7)
+    for n in (1000, 10000, 100000, 1000000):
+        columns, seconds = timed(lambda: minConflicts(n, seed=0))
+        ok = columns is not None and isSolution(columns)
+        print(f"n={n}: {seconds:.3f}s, valid={ok}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # python nqueens.py N prints one board of N queens
+        n = int(sys.argv[1])
+        columns = minConflicts(n) if n > 64 else queensCSP(n).solve()
+        if columns is None:
+            print("No solution")
+        else:
+            printBoard([columns[row] for row in range(n)])
+    else:
+        benchmark()
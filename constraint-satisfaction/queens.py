@@ -1,4 +1,4 @@
-from csp import CSP
+from csp import CSP, Constraint
 
 def printBoard(board):
 	print("Board:")
@@ -19,85 +19,87 @@ domains = {var: ['Q', '.'] for var in variables}
 # ↖ ↑ ↗
 # ← · →
 # ↙ ↓ ↘
-
-# Check that at most one queen is in any column ↓
-def columnConstraint(var, value, assignment):
-	if value != 'Q':
-		return True
-	for y in range(8):
-		if y != var[0]:
-			pos = (y, var[1])
-			if pos in assignment and assignment[pos] == 'Q':
+#
+# Rather than walking every row, column and diagonal on each call,
+# keep a running count of the queens on each of them. The solver
+# tells us whenever a cell is set or cleared
+class QueensConstraint(Constraint):
+	def __init__(self):
+		super().__init__(self.check, variables)
+
+	def reset(self):
+		self.rows = [0] * 8
+		self.columns = [0] * 8
+		# ↘ diagonals have a constant y - x, ↗ diagonals a constant y + x
+		self.downDiagonals = [0] * 15
+		self.upDiagonals = [0] * 15
+		self.queens = 0
+		self.assigned = 0
+		# How many cells of each row have been decided
+		self.rowCells = [0] * 8
+
+	def update(self, var, value, step):
+		self.assigned += step
+		y, x = var
+		self.rowCells[y] += step
+		if value != 'Q':
+			return
+		self.rows[y] += step
+		self.columns[x] += step
+		self.downDiagonals[y - x + 7] += step
+		self.upDiagonals[y + x] += step
+		self.queens += step
+
+	def onAssign(self, var, value):
+		self.update(var, value, 1)
+
+	def onUnassign(self, var, value):
+		self.update(var, value, -1)
+
+	def check(self, var, value, assignment):
+		# Leave var out of the counts while we check it
+		current = assignment.get(var)
+		if current is not None:
+			self.update(var, current, -1)
+		ok = self.allowed(var, value)
+		if current is not None:
+			self.update(var, current, 1)
+		return ok
+
+	def allowed(self, var, value):
+		y, x = var
+		queens = self.queens
+		if value == 'Q':
+			# At most one queen in any row, column or diagonal
+			if self.rows[y] or self.columns[x]:
 				return False
-	return True
-
-# Check that at most one queen is in any column →
-def rowConstraint(var, value, assignment):
-	if value != 'Q':
-		return True
-	for x in range(8):
-		if x != var[1]:
-			pos = (var[0], x)
-			if pos in assignment and assignment[pos] == 'Q':
+			if self.downDiagonals[y - x + 7] or self.upDiagonals[y + x]:
 				return False
-	return True
-
-# Check that at most one queen in any diagonal
-def diagonalConstraint(var, value, assignment):
-	if value != 'Q':
+			queens += 1
+		elif self.rows[y] == 0 and self.rowCells[y] == 7:
+			# Last cell of a row without a queen, 8 queens on
+			# 8 rows means every row needs one
+			return False
+		if self.assigned + 1 == 64:
+			# Final board must have 8 queens
+			return queens == 8
 		return True
-	for i in range(1,8):
-		# First check ↘
-		pos = (var[0]+i, var[1]+i)
-		if pos[0] < 8 and pos[1] < 8:
-			if pos in assignment and assignment[pos] == 'Q':
-				return False
-		# Next check ↗
-		pos = (var[0]-i, var[1]+i)
-		if pos[0] >= 0 and pos[1] < 8:
-			if pos in assignment and assignment[pos] == 'Q':
-				return False
-		# Next check ↖
-		pos = (var[0]-i, var[1]-i)
-		if pos[0] >= 0 and pos[1] >= 0:
-			if pos in assignment and assignment[pos] == 'Q':
-				return False
-		# Lastly check ↙
-		pos = (var[0]+i, var[1]-i)
-		if pos[0] < 8 and pos[1] >= 0:
-			if pos in assignment and assignment[pos] == 'Q':
-				return False
-	return True
-
-# Check that final board has 8 queens
-def eightQueensConstraint(var, value, assignment):
-	count = 0
-	for y in range(8):
-		for x in range(8):
-			if (y,x) not in assignment:
-				# Only run if all points are assigned
-				return True
-			if assignment[(y,x)] == 'Q':
-				count += 1
-	# Final board must have 8 queens
-	return count == 8
 
 
 # Constraints
-constraints = [
-    columnConstraint,
-    rowConstraint,
-    diagonalConstraint,
-    eightQueensConstraint,
-]
+constraints = [QueensConstraint()]
+
+if __name__ == "__main__":
+	print("*"*7, "Solution", "*"*7)
+	csp = CSP(variables, domains, constraints, inference="fc")
+	sol = csp.solve()
 
-print("*"*7, "Solution", "*"*7)
-csp = CSP(variables, domains, constraints)
-sol = csp.solve()
+	solution = [['?' for i in range(8)] for i in range(8)]
+	for i, j in sol:
+		solution[i][j] = sol[(i, j)]
 
-solution = [['?' for i in range(8)] for i in range(8)]
-for i, j in sol:
-    solution[i][j] = sol[(i, j)]
 
+	printBoard(solution)
 
-printBoard(solution)
\ No newline at end of file
+	print("*"*7, "Counting", "*"*7)
+	print(csp.countSolutions(), "solutions")
@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from csp import CSP
+from csp import CSP, Constraint, GlobalCardinality, SoftConstraint
 
 def generateConsecutiveDates(start_date, end_date):
     # Parse the input dates
@@ -56,16 +56,62 @@ def noConsecutiveDaysConstraint(var, value, assignment):
         return False
     return True
 
-# Makes sure that no one is assigned to too many days
-def maxDaysConstraint(var, value, assignment):
-    global variables, ALL_PEOPLE
-    count = 0
-    for day in variables:
-        if day != var and day in assignment:
-            if assignment[day] == value:
-                count += 1
-    # Make sure no one is assigned to too many days
-    return count <= len(variables) / len(ALL_PEOPLE)
+# The same rule for just one pair of days. It only ever looks at those
+# two, so the solver is free to cache its answers
+def notTwoDaysRunning(yesterday, today):
+    def fn(var, value, assignment):
+        other = today if var == yesterday else yesterday
+        return assignment.get(other) != value
+    return Constraint(fn, [yesterday, today], pure=True)
+
+# Makes sure that no one is assigned to too many days,
+# keeps a running count per person instead of recounting every day
+class MaxDaysConstraint(Constraint):
+    def __init__(self, days, people):
+        super().__init__(self.check, days)
+        self.limit = len(days) / len(people)
+
+    def reset(self):
+        self.counts = {}
+
+    def onAssign(self, var, value):
+        self.counts[value] = self.counts.get(value, 0) + 1
+
+    def onUnassign(self, var, value):
+        self.counts[value] -= 1
+
+    def check(self, var, value, assignment):
+        count = self.counts.get(value, 0)
+        if var in assignment and assignment[var] == value:
+            count -= 1
+        # Make sure no one is assigned to too many days
+        return count <= self.limit
+
+    def culprits(self, var, value, assignment):
+        # Only the days value already works can push them over
+        return {day for day in self.scope if day != var and assignment.get(day) == value}
+
+# Rather than a hard limit, charge for every day someone
+# works past their fair share
+class FairShareConstraint(SoftConstraint):
+    def __init__(self, days, people, weight=1):
+        super().__init__(self.check, days, weight)
+        self.share = -(-len(days) // len(people))
+
+    def reset(self):
+        self.counts = {}
+
+    def onAssign(self, var, value):
+        self.counts[value] = self.counts.get(value, 0) + 1
+
+    def onUnassign(self, var, value):
+        self.counts[value] -= 1
+
+    def check(self, var, value, assignment):
+        count = self.counts.get(value, 0)
+        if var in assignment and assignment[var] == value:
+            count -= 1
+        return count < self.share
 
 # Makes sure that everyone is assigned to atleast 5 days
 def minDaysConstraint(var, value, assignment):
@@ -94,93 +140,189 @@ def unavailableConstraint(unavailable):
             if value in unavailable[day]:
                 return False
         return True
-    return fn
+    # Only the listed days can break it, and only var and value matter
+    return Constraint(fn, [datetime.strptime(day, "%Y-%m-%d") for day in unavailable], pure=True)
 
 # Makes sure that no one is assigned to more than 1 major holiday
-def onlyOneHolidayConstraint(var, value, assignment):
-    holidays = [
-        datetime.strptime(date, "%Y-%m-%d") for date in [
-            "2024-11-28", # THANKSGIVING
-            "2024-11-29", # BLACK_FRIDAY
-            "2024-12-24", # XMAS_EVE
-            "2024-12-25", # XMAS_DAY
-            "2024-12-31", # NY_EVE
-            "2025-01-01", # NY_DAY
-        ]
+HOLIDAYS = [
+    datetime.strptime(date, "%Y-%m-%d") for date in [
+        "2024-11-28", # THANKSGIVING
+        "2024-11-29", # BLACK_FRIDAY
+        "2024-12-24", # XMAS_EVE
+        "2024-12-25", # XMAS_DAY
+        "2024-12-31", # NY_EVE
+        "2025-01-01", # NY_DAY
     ]
-
+]
+def onlyOneHolidayConstraint(var, value, assignment):
     # Only run constraint on holidays
-    if var not in holidays:
+    if var not in HOLIDAYS:
         return True
 
-    for holiday in holidays:
+    for holiday in HOLIDAYS:
         if holiday != var and holiday in assignment:
             if assignment[holiday] == value:
                 return False
 
     return True
 
-# Step 1
-print("Step 1 - No Constraints")
-csp = CSP(variables, domains)
-sol = csp.solve()
+# The full roster, any window of days and any team. Everyone works the
+# same number of days, give or take a couple
+def rosterCSP(start_date, end_date, people, **options):
+    days = generateConsecutiveDates(start_date, end_date)
+    share = len(days) // len(people)
+    constraints = [
+        # One for each pair of neighbouring days
+        *[notTwoDaysRunning(yesterday, today) for yesterday, today in zip(days, days[1:])],
+        # Counts days per person as we go instead of recounting every time,
+        # and gives up as soon as someone can no longer reach their minimum
+        GlobalCardinality(days, {person: (share - 2, share + 2) for person in people}),
+        # Leaving out any days that fall outside the window
+        unavailableConstraint({
+            day: names for day, names in {
+                "2024-11-28": ["Alice", "Curtis"],
+                "2024-12-31": ["Bob"],
+            }.items() if datetime.strptime(day, "%Y-%m-%d") in days
+        }),
+        Constraint(onlyOneHolidayConstraint, [day for day in HOLIDAYS if day in days], pure=True),
+    ]
+    # A bad run of luck can starve someone of days right up until the end
+    # of the year, so start over every so often instead of digging out.
+    # Backjumping skips straight past days that had nothing to do with it
+    options.setdefault("inference", "fc")
+    options.setdefault("restarts", "luby")
+    options.setdefault("backjumping", True)
+    return CSP(days, {day: people for day in days}, constraints, **options)
 
-printSchedule(sol)
+if __name__ == "__main__":
+    # Step 1
+    print("Step 1 - No Constraints")
+    csp = CSP(variables, domains)
+    sol = csp.solve()
 
-# Step 2
-print("Step 2 - No Consecutive Days Scheduled")
-constraints = [
-    noConsecutiveDaysConstraint
-]
-csp = CSP(variables, domains, constraints)
-sol = csp.solve()
+    printSchedule(sol)
+
+    # Step 2
+    print("Step 2 - No Consecutive Days Scheduled")
+    constraints = [
+        noConsecutiveDaysConstraint
+    ]
+    csp = CSP(variables, domains, constraints)
+    sol = csp.solve()
 
-printSchedule(sol)
+    printSchedule(sol)
 
-# Step 3
-print("Step 3 - Max Days Scheduled per Person")
-constraints = [
-    noConsecutiveDaysConstraint,
-    maxDaysConstraint
-]
-csp = CSP(variables, domains, constraints)
-sol = csp.solve()
-
-printSchedule(sol)
-
-# Step 4
-print("Step 4 - Unavailable Days")
-constraints = [
-    noConsecutiveDaysConstraint,
-    maxDaysConstraint,
-    unavailableConstraint({
-        "2024-11-28": ["Alice", "Curtis"],
-        "2024-12-31": ["Bob"],
-    }),
-]
-csp = CSP(variables, domains, constraints)
-sol = csp.solve()
+    # Step 3
+    print("Step 3 - Max Days Scheduled per Person")
+    constraints = [
+        noConsecutiveDaysConstraint,
+        MaxDaysConstraint(variables, ALL_PEOPLE)
+    ]
+    csp = CSP(variables, domains, constraints)
+    sol = csp.solve()
 
-printSchedule(sol)
+    printSchedule(sol)
 
-print("Step 5 - Larger Time Window")
-ALL_PEOPLE += [
-    "Doug",
-    "Ethan",
-    "Frank"
-]
-variables = generateConsecutiveDates("2024-11-23", "2025-01-01")
-domains = {day: ALL_PEOPLE for day in variables}
-constraints = [
-    noConsecutiveDaysConstraint,
-    maxDaysConstraint,
-    unavailableConstraint({
-        "2024-11-28": ["Alice", "Curtis"],
-        "2024-12-31": ["Bob"],
-    }),
-    onlyOneHolidayConstraint,
-]
-csp = CSP(variables, domains, constraints)
-sol = csp.solve()
+    # Step 4
+    print("Step 4 - Unavailable Days")
+    constraints = [
+        noConsecutiveDaysConstraint,
+        MaxDaysConstraint(variables, ALL_PEOPLE),
+        unavailableConstraint({
+            "2024-11-28": ["Alice", "Curtis"],
+            "2024-12-31": ["Bob"],
+        }),
+    ]
+    csp = CSP(variables, domains, constraints)
+    sol = csp.solve()
+
+    printSchedule(sol)
+    # For planning it helps to know how much freedom is left
+    print(csp.countSolutions(), "possible schedules\n\n")
+
+    print("Step 5 - Larger Time Window")
+    ALL_PEOPLE += [
+        "Doug",
+        "Ethan",
+        "Frank"
+    ]
+    variables = generateConsecutiveDates("2024-11-23", "2025-01-01")
+    domains = {day: ALL_PEOPLE for day in variables}
+    constraints = [
+        noConsecutiveDaysConstraint,
+        MaxDaysConstraint(variables, ALL_PEOPLE),
+        unavailableConstraint({
+            "2024-11-28": ["Alice", "Curtis"],
+            "2024-12-31": ["Bob"],
+        }),
+        # Only holidays can break this one, so scope it to them
+        Constraint(onlyOneHolidayConstraint, HOLIDAYS),
+    ]
+    csp = CSP(variables, domains, constraints)
+    # Some random starts get stuck for a long time here,
+    # so race a few of them and keep the first schedule
+    sol = csp.solveParallel(workers=4)
+
+    printSchedule(sol)
+
+    print("Step 6 - Full Year")
+    csp = rosterCSP("2024-11-23", "2025-11-22", ALL_PEOPLE)
+    sol = csp.solve()
+
+    printSchedule(sol)
+
+    print("Step 7 - Full Year, Local Search")
+    # Same roster, but repair a complete schedule until it breaks
+    # no rules instead of building it up one day at a time
+    sol = csp.minConflicts()
+
+    printSchedule(sol)
+
+    print("Step 8 - Best Roster")
+    # Only the rules nobody can break stay hard, the rest have a
+    # price and we look for the cheapest schedule
+    variables = generateConsecutiveDates("2024-11-23", "2025-01-01")
+    domains = {day: ALL_PEOPLE for day in variables}
+    constraints = [
+        *[
+            Constraint(noConsecutiveDaysConstraint, [yesterday, today])
+            for yesterday, today in zip(variables, variables[1:])
+        ],
+        unavailableConstraint({
+            "2024-11-28": ["Alice", "Curtis"],
+            "2024-12-31": ["Bob"],
+        }),
+        # Spread the days out as evenly as we can
+        FairShareConstraint(variables, ALL_PEOPLE),
+        # Working two holidays is bad, but not the end of the world
+        SoftConstraint(onlyOneHolidayConstraint, HOLIDAYS, weight=5),
+        # Alice would rather keep her weekends free
+        SoftConstraint(
+            lambda var, value, assignment: value != "Alice",
+            [day for day in variables if day.weekday() >= 5],
+        ),
+    ]
+    csp = CSP(variables, domains, constraints, inference="fc")
+    # Every schedule it gives us beats the one before, keep the last
+    # one we get before running out of time
+    sol = None
+    for cost, sol in csp.optimize(timeout=5):
+        print("Found a schedule costing", cost)
+
+    printSchedule(sol)
+
+    print("Step 9 - Changing Availability")
+    # Plans change after the roster is out. Rather than starting over,
+    # repair the old roster so as few days as possible move around
+    csp = rosterCSP("2024-11-23", "2025-11-22", ALL_PEOPLE)
+    sol = dict(csp.solve())
+    # Whoever is on these days can no longer make it
+    unavailable = {
+        day: [sol[datetime.strptime(day, "%Y-%m-%d")]]
+        for day in ["2025-03-03", "2025-03-04", "2025-07-04"]
+    }
+    new = csp.resolve(sol, add=[unavailableConstraint(unavailable)])
+    if new is not None:
+        print(sum(new[day] != sol[day] for day in sol), "days changed hands")
 
-printSchedule(sol)
+    printSchedule(new)
@@ -1,4 +1,4 @@
-from csp import CSP
+from csp import CSP, AllDifferent, BitsetDomains
 
 # Define the Sudoku puzzle as a 9x9 grid
 puzzle = [[5, 3, 0, 0, 7, 0, 0, 0, 0],
@@ -11,70 +11,65 @@ puzzle = [[5, 3, 0, 0, 7, 0, 0, 0, 0],
           [0, 0, 0, 4, 1, 9, 0, 0, 5],
           [0, 0, 0, 0, 8, 0, 0, 0, 0]]
 
+# Works for any n^2 x n^2 grid, e.g. 16x16 or 25x25
+SIZE = len(puzzle)
+BOX = int(SIZE ** 0.5)
+
 # Function to display the Sudoku puzzle
 def printSudoku(puzzle):
-    for i in range(9):
-        if i % 3 == 0 and i != 0:
-            print("- - - - - - - - - - - ")
-        for j in range(9):
-            if j % 3 == 0 and j != 0:
+    width = len(str(SIZE))
+    for i in range(SIZE):
+        if i % BOX == 0 and i != 0:
+            print("- " * ((width + 1) * SIZE // 2 + BOX - 1))
+        for j in range(SIZE):
+            if j % BOX == 0 and j != 0:
                 print(" | ", end="")
-            print(puzzle[i][j], end=" ")
+            print(str(puzzle[i][j]).rjust(width), end=" ")
         print()
 
-# Print the initial puzzle
-printSudoku(puzzle)
-
-# Variables
-variables = [(i, j) for i in range(9) for j in range(9)]
+# Constraints, every row, column and sub grid is all different
+def sudokuCSP(puzzle, **options):
+    # Any square puzzle, not just the one above. Options go straight
+    # to CSP, by default MAC with bitmask domains
+    size = len(puzzle)
+    box = int(size ** 0.5)
 
-# Domains
-domains = {var: list(range(1, 10)) if puzzle[var[0]][var[1]] == 0 
-           else {puzzle[var[0]][var[1]]} for var in variables}
+    # Variables
+    variables = [(i, j) for i in range(size) for j in range(size)]
 
-def columnConstraint(var, value, assignment):
-    for y in range(9):
-        if y != var[1]:
-            point = (var[0], y)
-            if point in assignment and assignment[point] == value:
-                return False
-    return True
+    # Domains
+    domains = {var: list(range(1, size + 1)) if puzzle[var[0]][var[1]] == 0
+               else {puzzle[var[0]][var[1]]} for var in variables}
 
-def rowConstraint(var, value, assignment):
-    for x in range(9):
-        if x != var[0]:
-            point = (x, var[1])
-            if point in assignment and assignment[point] == value:
-                return False
-    return True
+    constraints = []
+    for n in range(size):
+        constraints.append(AllDifferent([(n, y) for y in range(size)]))
+        constraints.append(AllDifferent([(x, n) for x in range(size)]))
+        sub_x, sub_y = n // box, n % box
+        constraints.append(AllDifferent([
+            (x, y)
+            for x in range(sub_x * box, (sub_x + 1) * box)
+            for y in range(sub_y * box, (sub_y + 1) * box)
+        ]))
 
-def subgridConstraint(var, value, assignment):
-    sub_x, sub_y = var[0] // 3, var[1] // 3
-    for x in range(sub_x * 3, (sub_x + 1) * 3):
-        for y in range(sub_y * 3, (sub_y + 1) * 3):
-            point = (x, y)
-            if point != var:
-                if point in assignment and assignment[point] == value:
-                    return False
-    return True
+    options.setdefault("inference", "mac")
+    options.setdefault("domain_store", BitsetDomains)
+    return CSP(variables, domains, constraints, **options)
 
-# Constraints
-constraints = [
-    columnConstraint,
-    rowConstraint,
-    subgridConstraint,
-]
+if __name__ == "__main__":
+    # Print the initial puzzle
+    printSudoku(puzzle)
 
-# Solve the Sudoku puzzle using CSP
-print("*"*7, "Solution", "*"*7)
-csp = CSP(variables, domains, constraints)
-sol = csp.solve()
+    # Solve the Sudoku puzzle using CSP
+    print("*"*7, "Solution", "*"*7)
+    csp = sudokuCSP(puzzle)
+    sol = csp.solve()
 
-# Format the solution for output
-solution = [[0 for i in range(9)] for i in range(9)]
-for i, j in sol:
-    solution[i][j] = sol[i, j]
+    # Format the solution for output
+    solution = [[0 for i in range(SIZE)] for i in range(SIZE)]
+    for i, j in sol:
+        solution[i][j] = sol[i, j]
 
 
-# Print the solved Sudoku puzzle
-printSudoku(solution)
\ No newline at end of file
+    # Print the solved Sudoku puzzle
+    printSudoku(solution)
\ No newline at end of file
@@ -0,0 +1,209 @@
+import argparse
+import multiprocessing
+import sys
+import time
+
+from csp import CSP, Constraint, BitsetDomains
+
+# Solves a stream of puzzles, one per line, e.g.
+#   python sudokubatch.py puzzles.txt -o solutions.txt
+#   cat puzzles.txt | python sudokubatch.py > solutions.txt
+# A puzzle is its cells row by row, with '.' or '0' for blanks.
+# Any n^2 x n^2 size works, above 9x9 the digits carry on as letters
+SYMBOLS = "123456789ABCDEFGHIJKLMNOP"
+BLANKS = ".0"
+
+# Puzzles of the same size share everything but their givens, so the
+# tables below are only ever worked out once per size
+TABLES = {}
+
+def tables(size):
+    # Cells are numbered row by row. Units are the rows, columns and
+    # boxes, cellUnits the units each cell is in, and a cell's peers
+    # are every other cell in one of its units
+    if size not in TABLES:
+        box = int(size ** 0.5)
+        rows = [[r * size + c for c in range(size)] for r in range(size)]
+        columns = [[r * size + c for r in range(size)] for c in range(size)]
+        boxes = [
+            [r * size + c
+             for r in range(br * box, (br + 1) * box)
+             for c in range(bc * box, (bc + 1) * box)]
+            for br in range(box) for bc in range(box)
+        ]
+        units = rows + columns + boxes
+        cellUnits = [[i for i, unit in enumerate(units) if cell in unit] for cell in range(size * size)]
+        peers = [
+            sorted({other for i in cellUnits[cell] for other in units[i]} - {cell})
+            for cell in range(size * size)
+        ]
+        TABLES[size] = (units, cellUnits, peers)
+    return TABLES[size]
+
+class PeersConstraint(Constraint):
+    # No cell shares its value with a peer. Instead of one AllDifferent
+    # per unit this looks the peers up in the table, and only has to
+    # clear the value of the cell that was just filled in from them.
+    # Every cell has the same values in the same order, so it can read
+    # BitsetDomains' masks directly and check a whole unit at once
+    def __init__(self, size):
+        super().__init__(self.check, range(size * size))
+        self.symbols = SYMBOLS[:size]
+        self.full = (1 << size) - 1
+        self.units, self.cellUnits, self.peers = tables(size)
+        self.last = None
+
+    def reset(self):
+        self.last = None
+
+    def onAssign(self, var, value):
+        self.last = (var, value)
+
+    def onUnassign(self, var, value):
+        self.last = None
+
+    def check(self, var, value, assignment):
+        for peer in self.peers[var]:
+            if assignment.get(peer) == value:
+                return False
+        return True
+
+    def propagate(self, csp, assignment):
+        if self.last is None:
+            return []
+        masks = csp.store.masks
+        symbols = self.symbols
+        changed = []
+        queue = [self.last]
+        while queue:
+            # Clear each new value from the peers. Any peer left with one
+            # value is as good as filled in, so that gets cleared too
+            touched = set()
+            while queue:
+                cell, value = queue.pop()
+                bit = 1 << symbols.index(value)
+                for peer in self.peers[cell]:
+                    if peer in assignment or not masks[peer] & bit:
+                        continue
+                    csp.prune(peer, value)
+                    mask = masks[peer]
+                    if mask == 0:
+                        return None
+                    if mask & (mask - 1) == 0:
+                        queue.append((peer, symbols[mask.bit_length() - 1]))
+                    changed.append(peer)
+                    touched.update(self.cellUnits[peer])
+            # A value with only one place left in a unit has to go there
+            for unit in touched:
+                once = twice = 0
+                for cell in self.units[unit]:
+                    twice |= once & masks[cell]
+                    once |= masks[cell]
+                if once != self.full:
+                    # Some value has nowhere to go
+                    return None
+                single = once & ~twice
+                if not single:
+                    continue
+                for cell in self.units[unit]:
+                    mask = masks[cell]
+                    if mask & single and mask & (mask - 1):
+                        value = symbols[(mask & single).bit_length() - 1]
+                        csp.force(cell, value)
+                        queue.append((cell, value))
+                        changed.append(cell)
+        return changed
+
+class SudokuCSP(CSP):
+    # Every cell starts with every value, the givens are
+    # filled into the fresh domains before each search
+    def __init__(self, size):
+        variables = list(range(size * size))
+        everything = list(SYMBOLS[:size])
+        super().__init__(
+            variables,
+            {cell: everything for cell in variables},
+            [PeersConstraint(size)],
+            inference="fc",
+            domain_store=BitsetDomains,
+        )
+        self.givens = {}
+
+    def prepare(self, assignment):
+        if not super().prepare(assignment):
+            return False
+        for cell, value in self.givens.items():
+            if not self.store.contains(cell, value):
+                return False
+            self.store.assign(cell, value)
+        return True
+
+# Set up once in every worker process and reused for every puzzle
+solver = None
+
+def startWorker(size):
+    global solver
+    solver = SudokuCSP(size)
+
+def solveLine(line):
+    line = line.strip()
+    if len(line) != len(solver.variables):
+        return "No solution"
+    solver.givens = {cell: symbol for cell, symbol in enumerate(line) if symbol not in BLANKS}
+    solution = solver.solve()
+    if solution is None:
+        return "No solution"
+    return "".join(solution[cell] for cell in solver.variables)
+
+def puzzleLines(stream):
+    for line in stream:
+        if line.strip():
+            yield line
+
+def solveStream(source, out, workers=None, chunksize=64, report_every=10000):
+    # Solutions come out in the same order as the puzzles went in,
+    # each one written as soon as it and everything before it is done
+    lines = puzzleLines(source)
+    first = next(lines, None)
+    if first is None:
+        return 0
+    size = int(len(first.strip()) ** 0.5)
+    if size * size != len(first.strip()) or size > len(SYMBOLS):
+        raise ValueError(f"Not a puzzle: {first.strip()}")
+
+    def everyLine():
+        yield first
+        yield from lines
+
+    start = time.perf_counter()
+    solved = 0
+    with multiprocessing.Pool(workers, initializer=startWorker, initargs=(size,)) as pool:
+        for solution in pool.imap(solveLine, everyLine(), chunksize):
+            out.write(solution + "\n")
+            solved += 1
+            if solved % report_every == 0:
+                out.flush()
+                report(solved, time.perf_counter() - start)
+    out.flush()
+    report(solved, time.perf_counter() - start)
+    return solved
+
+def report(solved, seconds):
+    print(f"{solved} puzzles in {seconds:.1f}s, {solved / max(seconds, 1e-9):.0f} puzzles/sec", file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve Sudoku puzzles, one per line")
+    parser.add_argument("puzzles", nargs="?", help="file of puzzles, stdin if left out")
+    parser.add_argument("-o", "--output", help="file for the solutions, stdout if left out")
+    parser.add_argument("-w", "--workers", type=int, help="processes to use, one per CPU by default")
+    args = parser.parse_args()
+
+    source = open(args.puzzles) if args.puzzles else sys.stdin
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        solveStream(source, out, args.workers)
+    finally:
+        if args.puzzles:
+            source.close()
+        if args.output:
+            out.close()
@@ -22,13 +22,14 @@ constraints = [
     neighborConstraint
 ]
 
-print("*"*7, "Solution", "*"*7)
-csp = CSP(variables, domains, constraints)
-sol = csp.solve()
+if __name__ == "__main__":
+	print("*"*7, "Solution", "*"*7)
+	csp = CSP(variables, domains, constraints)
+	sol = csp.solve()
 
-# Blank Solution
-solution = ['' for i in range(3)]
-for i in sol:
-	solution[i] = sol[i]
+	# Blank Solution
+	solution = ['' for i in range(3)]
+	for i in sol:
+		solution[i] = sol[i]
 
-print(' '.join(solution))
\ No newline at end of file
+	print(' '.join(solution))
\ No newline at end of file
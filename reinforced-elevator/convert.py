@@ -0,0 +1,25 @@
+import sys
+
+from elevator import ElevatorController
+
+# Converts a pickled model into the memory mapped format, e.g.
+#	python convert.py complex models/complex_elevator.pkl models/complex_elevator.qtable
+# The configuration has to match the one the model was trained with,
+# the same ones as in main.py
+CONFIGS = {
+	"simple": dict(num_elevators=1, num_floors=3, max_capacity=2),
+	"complex": dict(max_capacity=2),
+	"gigantic": dict(max_capacity=4, num_floors=10),
+}
+
+def convert(controller, pkl_filename, filename):
+	# Old dict models get moved into the numbered table on load
+	controller.load(pkl_filename)
+	controller.saveMapped(filename)
+
+if __name__ == "__main__":
+	if len(sys.argv) != 4 or sys.argv[1] not in CONFIGS:
+		print(f"Usage: python convert.py [{'|'.join(CONFIGS)}] model.pkl model.qtable")
+		sys.exit(1)
+	config, pkl_filename, filename = sys.argv[1:]
+	convert(ElevatorController(phase_space=True, **CONFIGS[config]), pkl_filename, filename)
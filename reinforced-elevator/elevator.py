@@ -4,7 +4,7 @@ import math
 import itertools
 
 class ElevatorController(RFLearner):
-	def __init__(self, num_floors=5, num_elevators=2, max_capacity=2, goal_iters=1000, new_call_prob=0.3, **kwargs):
+	def __init__(self, num_floors=5, num_elevators=2, max_capacity=2, goal_iters=1000, new_call_prob=0.3, phase_space=False, **kwargs):
 		self.num_floors = num_floors
 		self.num_elevators = num_elevators
 		self.max_capacity = max_capacity
@@ -13,12 +13,164 @@ class ElevatorController(RFLearner):
 		# Number of iterations until the elevator reaches its goal
 		self.goal_iters = goal_iters
 
+		# Number every state so the learner can use a dense table. The
+		# count grows very fast, fine for the simple and complex setups
+		# but far too big for the gigantic one
+		self.phase_space = phase_space
+		if phase_space:
+			# An elevator's occupancy is always the number of desired
+			# floors, which are sorted. Each way of filling k seats gets
+			# a number from the combinatorial number system, after those
+			# of the fewer seated groups
+			self.binomial = np.array([
+				[math.comb(n, r) for r in range(max_capacity + 2)]
+				for n in range(num_floors + max_capacity + 1)
+			])
+			groups = [math.comb(num_floors + k - 1, k) for k in range(max_capacity + 1)]
+			self.group_offsets = np.cumsum([0] + groups[:-1])
+			self.num_groups = sum(groups)
+
+			# Everything a single elevator can be doing, by number
+			self.elevator_states = [None] * (num_floors * self.num_groups * 2)
+			for floor in range(num_floors):
+				for occupants in range(max_capacity + 1):
+					for desired_floors in itertools.combinations_with_replacement(range(num_floors), occupants):
+						for moving in (False, True):
+							e = (floor, occupants, desired_floors, moving)
+							self.elevator_states[self.elevatorId(e)] = e
+			self.elevator_ids = {e: i for i, e in enumerate(self.elevator_states)}
+
 		# self.goal = (2,2)
 		super().__init__(**kwargs)
 
 	def getActions(self):
 		return list(itertools.product(*[[-1,0,1] for i in range(self.num_elevators)]))
 
+	def totalNumStates(self):
+		if not self.phase_space:
+			return None
+		# Any set of called floors, times every elevator's own state
+		return 2**self.num_floors * len(self.elevator_states)**self.num_elevators
+
+	def toPhaseSpace(self, user_state):
+		idx = 0
+		for call in user_state[0]:
+			idx |= 1 << int(call)
+		for e in user_state[1:]:
+			idx = idx * len(self.elevator_states) + self.elevator_ids[e]
+		return idx
+
+	def elevatorId(self, e):
+		floor, occupants, desired_floors, moving = e
+		group = self.group_offsets[occupants] + sum(
+			self.binomial[d + i, i + 1] for i, d in enumerate(desired_floors)
+		)
+		return int((floor * self.num_groups + group) * 2 + moving)
+
+	def fromPhaseSpace(self, idx):
+		elevators = []
+		for _ in range(self.num_elevators):
+			idx, i = divmod(idx, len(self.elevator_states))
+			elevators.append(self.elevator_states[i])
+		calls = tuple(floor for floor in range(self.num_floors) if idx >> floor & 1)
+		return (calls, *reversed(elevators))
+
+	# Batches of episodes as arrays, for train(batch=K). Every array has
+	# one entry per episode:
+	#	calls - (K, floors) bools, floors being called on
+	#	floors - (K, elevators) positions
+	#	desired - (K, elevators, capacity) desired floors, sorted, with
+	#	          num_floors in the seats nobody is in
+	#	moving - (K, elevators) bools
+	def startBatch(self, size):
+		return {
+			"calls": np.zeros((size, self.num_floors), dtype=bool),
+			"floors": np.zeros((size, self.num_elevators), dtype=np.int64),
+			"desired": np.full((size, self.num_elevators, self.max_capacity), self.num_floors, dtype=np.int64),
+			"moving": np.zeros((size, self.num_elevators), dtype=bool),
+		}
+
+	def applyActionBatch(self, states, actions):
+		# Same as applyAction, one elevator at a time across every episode
+		size = len(actions)
+		episodes = np.arange(size)
+		empty = self.num_floors
+		calls = states["calls"].copy()
+		floors = states["floors"].copy()
+		desired = states["desired"].copy()
+		moving = states["moving"].copy()
+		moves = np.array(self._actions)[actions]
+
+		for i in range(self.num_elevators):
+			a = moves[:, i]
+			floor = floors[:, i]
+			seats = desired[:, i]
+			stopped = a == 0
+			moving[:, i] = ~stopped
+
+			# Let people out
+			seats[stopped[:, None] & (seats == floor[:, None])] = empty
+			seats.sort(axis=1)
+			# Let people in, a floor is only ever called once
+			# so at most one person gets on
+			boarding = stopped & calls[episodes, floor] & (seats[:, -1] == empty)
+			calls[episodes[boarding], floor[boarding]] = False
+			destination = np.where(floor == 0, np.random.randint(1, self.num_floors - 1, size=size), 0)
+			seats[boarding, -1] = destination[boarding]
+			seats.sort(axis=1)
+
+			floors[:, i] = floor + a
+
+		# We are only going to have riders go to the bottom floor
+		called = np.random.rand(size) < self.new_call_prob
+		caller = np.random.randint(1, self.num_floors, size=size)
+		calls[episodes[called], caller[called]] = True
+
+		# Elevators must be kept within bounds
+		valid = ((floors >= 0) & (floors < self.num_floors)).all(axis=1)
+		next_states = {"calls": calls, "floors": floors, "desired": desired, "moving": moving}
+		for key, value in next_states.items():
+			value[~valid] = states[key][~valid]
+		return next_states, valid
+
+	def rewardBatch(self, states):
+		calls, floors, desired, moving = states["calls"], states["floors"], states["desired"], states["moving"]
+		waiting = calls.sum(axis=1)
+		occupancy = (desired < self.num_floors).sum(axis=(1, 2))
+		arrived = (desired == floors[:, :, None]).sum(axis=2)
+		drop_offs = np.where(moving, 0, arrived).sum(axis=1)
+		buttkick = ((floors == 0) & (waiting > 0)[:, None]).sum(axis=1)
+		if self.num_elevators < 2:
+			spacing = 0
+		else:
+			spacing = np.abs(np.diff(floors, axis=1)).mean(axis=1)
+		return -waiting - occupancy - buttkick + 10*(drop_offs**2) + spacing/2
+
+	def reachedGoalBatch(self, states, i):
+		return np.full(len(states["floors"]), i >= self.goal_iters)
+
+	def toPhaseSpaceBatch(self, states):
+		calls, floors, desired, moving = states["calls"], states["floors"], states["desired"], states["moving"]
+		idx = (calls * (1 << np.arange(self.num_floors))).sum(axis=1)
+		seat = np.arange(self.max_capacity)
+		for i in range(self.num_elevators):
+			seats = desired[:, i]
+			seated = seats < self.num_floors
+			group = self.group_offsets[seated.sum(axis=1)] + \
+				np.where(seated, self.binomial[seats + seat, seat + 1], 0).sum(axis=1)
+			e = (floors[:, i] * self.num_groups + group) * 2 + moving[:, i]
+			idx = idx * len(self.elevator_states) + e
+		return idx
+
+	def fromBatch(self, states, episode):
+		# One episode of a batch as a regular state
+		elevators = []
+		for i in range(self.num_elevators):
+			desired_floors = tuple(int(d) for d in states["desired"][episode, i] if d < self.num_floors)
+			elevators.append((int(states["floors"][episode, i]), len(desired_floors), desired_floors, bool(states["moving"][episode, i])))
+		calls = tuple(int(floor) for floor in np.flatnonzero(states["calls"][episode]))
+		return (calls, *elevators)
+
 	def elevator_spacing(self, lst):
 		# Ensure the list has at least two elements
 		if len(lst) < 2:
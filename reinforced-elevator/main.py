@@ -4,12 +4,12 @@ from matplotlib.animation import FuncAnimation, PillowWriter
 
 from elevator import ElevatorController
 
-# Gigantic
-# controller = ElevatorController(learning_rate=0.3, max_capacity=4, num_floors=10, epochs=1_000_000)
+# Gigantic, only practical with batches, e.g. controller.train(batch=1024)
+# controller = ElevatorController(learning_rate=0.3, max_capacity=4, num_floors=10, epochs=1_000_000, phase_space=True)
 ## Complex
-# controller = ElevatorController(learning_rate=0.3, max_capacity=2, epochs=100_000)
+# controller = ElevatorController(learning_rate=0.3, max_capacity=2, epochs=100_000, phase_space=True)
 ## Simple
-controller = ElevatorController(learning_rate=0.3, num_elevators=1, num_floors=3, max_capacity=2, epochs=10_000)
+controller = ElevatorController(learning_rate=0.3, num_elevators=1, num_floors=3, max_capacity=2, epochs=10_000, phase_space=True)
 
 controller.train()
 controller.save("simple_model.pkl")
@@ -17,6 +17,9 @@ controller.save("simple_model.pkl")
 # controller.load("gigantic_elevator.pkl")
 # controller.load("models/complex_elevator.pkl")
 # controller.load("models/simple_elevator.pkl")
+# Or the memory mapped versions made by convert.py, which start straight away
+# controller.loadMapped("models/complex_elevator.qtable")
+# controller.loadMapped("models/simple_elevator.qtable")
 
 # Parameters
 num_circles_per_row = 2  # Increased number of circles per row
@@ -1,10 +1,25 @@
 from abc import ABC, abstractmethod
 from typing import final
+import contextlib
 import numpy as np
 import math
+import multiprocessing
+import os
 import sys
 import pickle
 
+# Phase spaces with more states than this only get rows
+# for the states training actually visits
+MAX_DENSE_STATES = 2**22
+
+# Memory mapped models, see RFLearner.saveMapped. The file starts with
+# MAPPED_MAGIC, then five little endian int64s - version, rows, actions
+# and the offsets of the keys and of the values. The keys are the
+# sorted int64 state ids, the values a float32 rows x actions matrix
+MAPPED_MAGIC = b"RFQTABLE"
+MAPPED_VERSION = 1
+MAPPED_ALIGN = 4096
+
 def progress_bar(iterable, epochs, prefix="", length=40, fill="█"):
     total = epochs
     def print_bar(iteration):
@@ -21,6 +36,13 @@ def progress_bar(iterable, epochs, prefix="", length=40, fill="█"):
 
 
 class RFLearner(ABC):
+	# Learners whose applyAction, validState and reward depend on nothing
+	# but the state and action, and whose goal on nothing but the state,
+	# can set this. Along with the phase space methods, train() then works
+	# them all out once for every state and trains from the tables, as
+	# long as there are no more than MAX_DENSE_STATES of them
+	deterministic = False
+
 	def __init__(self, learning_rate=0.8, discount_factor=0.95, exploration_prob=0.2, epochs=1000):
 		self.learning_rate = learning_rate
 		self.discount_factor = discount_factor
@@ -28,27 +50,94 @@ class RFLearner(ABC):
 		self.epochs = epochs
 
 		self._actions = self.getActions()
-		
-		self.Q_table = {} # np.zeros((self.totalNumStates(), len(self._actions)))
-
-		# # Check phase conversions before continuing
-		# pigeons = set()
-		# for _ in range(1000):
-		# 	s = self.randomState()
-		# 	u = self.fromPhaseSpace(s)
-		# 	b = self.toPhaseSpace(u)
-		# 	assert s == b, f"Failed phase conversion: {s} to {u} to {b} ({s} != {b})"
-		# pass
+
+		# Learners that can number their states get one preallocated
+		# row per state, everyone else a dict of lists keyed by state
+		self.dense = self.totalNumStates() is not None
+		# State id -> row, when there are too many states to give them
+		# all a row up front. Rows are handed out as states turn up
+		self.row_of = None
+		# Visits per state and action, only counted while training
+		# in a worker process, see train(workers=...)
+		self.visits = None
+		# Sorted state ids when the table is memory mapped, the
+		# row of a state is where its id is in here
+		self.keys = None
+		# For deterministic learners, built by the first train():
+		# transitions[state, action] is the next state id or -1 if the
+		# move is not allowed, rewards and goals are per state id
+		self.transitions = None
+		self.rewards = None
+		self.goals = None
+		if self.dense:
+			self.Q_table = self._newTable()
+		else:
+			self.Q_table = {}
 
 	@abstractmethod
 	def getActions(self):
 		# Returns list of actions
 		pass
 
-	# @abstractmethod
-	# def fromPhaseSpace(self, idx):
-	# 	# Converts from phase space to user space
-	# 	pass
+	# Optional, learners that can number every state they can reach
+	# implement all three to swap the dict for a dense table
+	def totalNumStates(self):
+		# Number of states, None if the learner can't number them
+		return None
+
+	def toPhaseSpace(self, user_state):
+		# Converts from user space to an id in range(totalNumStates())
+		raise NotImplementedError
+
+	def fromPhaseSpace(self, idx):
+		# Converts from phase space to user space
+		raise NotImplementedError
+
+	def _newTable(self):
+		if self.totalNumStates() <= MAX_DENSE_STATES:
+			self.row_of = None
+			return np.zeros((self.totalNumStates(), len(self._actions)), dtype=np.float32)
+		self.row_of = {}
+		return np.zeros((1024, len(self._actions)), dtype=np.float32)
+
+	def _row(self, idx):
+		# Row of the table for a state id, adding one if it is new
+		if self.row_of is None:
+			return idx
+		row = self.row_of.get(idx)
+		if row is None:
+			row = self.row_of[idx] = len(self.row_of)
+			self._grow()
+		return row
+
+	def _rows(self, ids):
+		# Same as _row for an array of ids
+		if self.row_of is None:
+			return ids
+		row_of = self.row_of
+		rows = np.fromiter((row_of.setdefault(idx, len(row_of)) for idx in ids.tolist()), np.int64, len(ids))
+		self._grow()
+		return rows
+
+	def _grow(self):
+		# Double the table whenever the rows run out
+		if len(self.row_of) > len(self.Q_table):
+			rows = max(len(self.row_of), 2 * len(self.Q_table))
+			bigger = np.zeros((rows, len(self._actions)), dtype=np.float32)
+			bigger[:len(self.Q_table)] = self.Q_table
+			self.Q_table = bigger
+			if self.visits is not None:
+				visits = np.zeros((rows, len(self._actions)), dtype=np.int64)
+				visits[:len(self.visits)] = self.visits
+				self.visits = visits
+
+	@final
+	def checkPhaseSpace(self, user_state):
+		# Round trip a state through the conversions
+		idx = self.toPhaseSpace(user_state)
+		back = self.fromPhaseSpace(idx)
+		assert 0 <= idx < self.totalNumStates(), f"State id out of range: {user_state} to {idx}"
+		assert back == user_state, f"Failed phase conversion: {user_state} to {idx} to {back}"
 
 	@abstractmethod
 	def reward(self, user_state):
@@ -85,15 +174,125 @@ class RFLearner(ABC):
 	@final
 	def save(self, filename="model.pkl"):
 		with open(filename, "wb") as f:
-			pickle.dump(self.Q_table, f)
+			if self.keys is not None:
+				# Mapped rows are in key order, so they go back in as a
+				# table of only the rows in use that can be trained again
+				row_of = dict(zip(self.keys.tolist(), range(len(self.keys))))
+				pickle.dump((row_of, np.array(self.Q_table)), f)
+			elif self.row_of is not None:
+				# Only the rows in use, along with which state each is
+				pickle.dump((self.row_of, self.Q_table[:len(self.row_of)]), f)
+			else:
+				pickle.dump(self.Q_table, f)
 
 	@final
 	def load(self, filename="model.pkl"):
 		with open(filename, "rb") as f:
-			self.Q_table = pickle.load(f)
+			Q_table = pickle.load(f)
+		self.keys = None
+		if isinstance(Q_table, tuple):
+			self.row_of, self.Q_table = Q_table
+		elif self.dense and isinstance(Q_table, dict):
+			# Older models are always dicts, move them into our table
+			self.Q_table = self._newTable()
+			for user_state, values in Q_table.items():
+				self.Q_table[self._row(self.toPhaseSpace(user_state))] = values
+		else:
+			self.Q_table = Q_table
+
+	def _values(self, user_state):
+		# Action values of a state, whichever kind of table we have
+		if not self.dense:
+			return self.Q_table[user_state]
+		idx = self.toPhaseSpace(user_state)
+		if self.keys is not None:
+			row = np.searchsorted(self.keys, idx)
+			if row == len(self.keys) or self.keys[row] != idx:
+				# Never trained, same as a fresh row
+				return np.zeros(len(self._actions), dtype=np.float32)
+			return self.Q_table[row]
+		if self.row_of is not None:
+			idx = self.row_of.get(idx)
+			if idx is None:
+				return np.zeros(len(self._actions), dtype=np.float32)
+		return self.Q_table[idx]
+
+	@final
+	def saveMapped(self, filename="model.qtable"):
+		# Only the rows that were ever trained, sorted by state id so
+		# they can be found with a binary search without loading them
+		if not self.dense:
+			raise Exception("Mapped models need the phase space methods")
+		if self.keys is not None:
+			ids, rows = np.asarray(self.keys), np.arange(len(self.keys))
+		elif self.row_of is not None:
+			ids = np.fromiter(self.row_of.keys(), np.int64, len(self.row_of))
+			rows = np.fromiter(self.row_of.values(), np.int64, len(self.row_of))
+		else:
+			rows = np.flatnonzero(self.Q_table.any(axis=1))
+			ids = rows
+		order = np.argsort(ids)
+		ids, rows = ids[order], rows[order]
+
+		keys_offset = MAPPED_ALIGN
+		values_offset = keys_offset + -(-8 * len(ids) // MAPPED_ALIGN) * MAPPED_ALIGN
+		header = np.array([MAPPED_VERSION, len(ids), len(self._actions), keys_offset, values_offset], dtype="<i8")
+		with open(filename, "wb") as f:
+			f.write(MAPPED_MAGIC + header.tobytes())
+			f.seek(keys_offset)
+			f.write(ids.astype("<i8").tobytes())
+			f.seek(values_offset)
+			# A chunk at a time, so huge tables are never copied whole
+			for start in range(0, len(rows), 1 << 16):
+				f.write(np.asarray(self.Q_table[rows[start:start + (1 << 16)]], dtype="<f4").tobytes())
+
+	@final
+	def loadMapped(self, filename="model.qtable"):
+		# Nothing is read until a state is looked up, and then only the
+		# pages it needs. The table is read only, it is meant for run()
+		if not self.dense:
+			raise Exception("Mapped models need the phase space methods")
+		with open(filename, "rb") as f:
+			magic = f.read(len(MAPPED_MAGIC))
+			header = np.frombuffer(f.read(5 * 8), dtype="<i8")
+		if magic != MAPPED_MAGIC:
+			raise Exception(f"Not a mapped model: {filename}")
+		version, num_rows, num_actions, keys_offset, values_offset = (int(x) for x in header)
+		if version != MAPPED_VERSION:
+			raise Exception(f"Unknown mapped model version: {version}")
+		if num_actions != len(self._actions):
+			raise Exception(f"Model has {num_actions} actions, expected {len(self._actions)}")
+		if num_rows == 0:
+			self.keys = np.zeros(0, dtype=np.int64)
+			self.Q_table = np.zeros((0, num_actions), dtype=np.float32)
+		else:
+			self.keys = np.memmap(filename, dtype="<i8", mode="r", offset=keys_offset, shape=(num_rows,))
+			self.Q_table = np.memmap(filename, dtype="<f4", mode="r", offset=values_offset, shape=(num_rows, num_actions))
+		self.row_of = None
 
 	@final
-	def train(self):
+	def train(self, batch=None, workers=None, sync_every=None):
+		# batch=K steps K episodes at once, for learners that
+		# implement the batch methods below
+		if self.keys is not None:
+			raise Exception("Mapped models are read only, load a .pkl to keep training")
+		# Tables of only the visited rows are too big to tabulate,
+		# those train as if they weren't deterministic
+		cached = self.deterministic and self.dense and self.row_of is None
+		if cached:
+			self._buildTables()
+		elif batch is not None:
+			self._checkBatch()
+		if workers is not None:
+			return self._trainParallel(workers, batch, sync_every)
+		if batch is not None:
+			if cached:
+				return self._trainBatchCached(batch)
+			return self._trainBatch(batch)
+		if cached:
+			return self._trainCached()
+		if self.dense:
+			return self._trainDense()
 		# for epoch in range(self.epochs):
 		for epoch in progress_bar(range(self.epochs), self.epochs, length=10):
 			current_state = self.nextStartState(epoch)
@@ -131,6 +330,205 @@ class RFLearner(ABC):
 						 np.max(self.Q_table[next_state]) - self.Q_table[current_state][action])
 					current_state = next_state
 
+	def _trainDense(self):
+		# Same as train, but every state is a row number so there is
+		# no hashing of states and no lists to turn into arrays
+		num_actions = len(self._actions)
+		for epoch in progress_bar(range(self.epochs), self.epochs, length=10):
+			current_state = self.nextStartState(epoch)
+			current = self._row(self.toPhaseSpace(current_state))
+
+			counter = 0
+			while not self.reachedGoal(current_state, counter):
+				counter += 1
+				values = self.Q_table[current]
+
+				if np.random.rand() < self.exploration_prob:
+					action = np.random.randint(num_actions)
+				else:
+					action = values.argmax()
+
+				next_state = self._applyAction(current_state, action)
+
+				if self.visits is not None:
+					self.visits[current, action] += 1
+
+				# Invalid states will not be acceptable
+				if next_state == False:
+					values[action] = -np.inf
+					continue
+				reward = self.reward(next_state)
+				if reward == -np.inf:
+					values[action] = -np.inf
+					continue
+
+				following = self._row(self.toPhaseSpace(next_state))
+				# Adding a row can move the whole table
+				Q = self.Q_table
+				Q[current, action] += self.learning_rate * \
+					(reward + self.discount_factor * Q[following].max() - Q[current, action])
+				current_state, current = next_state, following
+
+	def _buildTables(self):
+		if self.transitions is not None:
+			return
+		assert self.row_of is None
+		num_states = self.totalNumStates()
+		transitions = np.full((num_states, len(self._actions)), -1, dtype=np.int64)
+		rewards = np.zeros(num_states)
+		goals = np.zeros(num_states, dtype=bool)
+		for idx in range(num_states):
+			user_state = self.fromPhaseSpace(idx)
+			if not self._validState(user_state):
+				continue
+			rewards[idx] = self.reward(user_state)
+			goals[idx] = self.reachedGoal(user_state, 0)
+			for action in range(len(self._actions)):
+				next_state = self._applyAction(user_state, action)
+				if next_state != False:
+					transitions[idx, action] = self.toPhaseSpace(next_state)
+		# Moves into states worth -inf are as good as not allowed
+		allowed = transitions >= 0
+		transitions[allowed & (rewards[transitions] == -np.inf)] = -1
+		self.transitions, self.rewards, self.goals = transitions, rewards, goals
+
+	def _trainCached(self):
+		# Same as _trainDense, but every step is a lookup in the tables.
+		# Plain lists index much faster than arrays one item at a time
+		Q = self.Q_table
+		transitions = self.transitions.tolist()
+		rewards = self.rewards.tolist()
+		goals = self.goals.tolist()
+		num_actions = len(self._actions)
+		for epoch in progress_bar(range(self.epochs), self.epochs, length=10):
+			current = self.toPhaseSpace(self.nextStartState(epoch))
+
+			while not goals[current]:
+				values = Q[current]
+
+				if np.random.rand() < self.exploration_prob:
+					action = np.random.randint(num_actions)
+				else:
+					action = values.argmax()
+
+				if self.visits is not None:
+					self.visits[current, action] += 1
+
+				following = transitions[current][action]
+				# Invalid states will not be acceptable
+				if following < 0:
+					values[action] = -np.inf
+					continue
+
+				values[action] += self.learning_rate * \
+					(rewards[following] + self.discount_factor * Q[following].max() - values[action])
+				current = following
+
+	def _trainBatchCached(self, size):
+		# Same as _trainBatch, with every episode stepped through the
+		# tables. Episodes that reach the goal drop out of the batch
+		Q = self.Q_table
+		num_actions = len(self._actions)
+		starts = range(0, self.epochs, size)
+		for start in progress_bar(starts, len(starts), length=10):
+			epochs = range(start, min(start + size, self.epochs))
+			current = np.array([self.toPhaseSpace(self.nextStartState(epoch)) for epoch in epochs], dtype=np.int64)
+			live = np.flatnonzero(~self.goals[current])
+
+			while len(live):
+				states = current[live]
+				greedy = Q[states].argmax(axis=1)
+				explore = np.random.rand(len(live)) < self.exploration_prob
+				actions = np.where(explore, np.random.randint(num_actions, size=len(live)), greedy)
+				following = self.transitions[states, actions]
+
+				if self.visits is not None:
+					np.add.at(self.visits, (states, actions), 1)
+
+				# Invalid states will not be acceptable
+				banned = following < 0
+				Q[states[banned], actions[banned]] = -np.inf
+
+				learn = ~banned
+				rows, acts, following = states[learn], actions[learn], following[learn]
+				Q[rows, acts] += self.learning_rate * \
+					(self.rewards[following] + self.discount_factor * Q[following].max(axis=1) - Q[rows, acts])
+
+				current[live[learn]] = following
+				live = live[~self.goals[current[live]]]
+
+	# Optional, learners that can simulate many episodes at once with
+	# arrays implement these to train with train(batch=K). A batch of
+	# states is whatever the learner likes, e.g. a dict of arrays with
+	# one entry per episode. Needs the phase space methods as well
+	def startBatch(self, size):
+		# Start states of size episodes
+		raise NotImplementedError
+
+	def applyActionBatch(self, states, actions):
+		# Apply one action (an index into getActions()) to every episode.
+		# Returns the next states and which moves were valid, episodes
+		# with invalid moves stay where they were
+		raise NotImplementedError
+
+	def rewardBatch(self, states):
+		raise NotImplementedError
+
+	def reachedGoalBatch(self, states, counter):
+		raise NotImplementedError
+
+	def toPhaseSpaceBatch(self, states):
+		# Array of state ids
+		raise NotImplementedError
+
+	def _checkBatch(self):
+		# Batches of episodes are numbered with toPhaseSpaceBatch, so
+		# both the phase space and the batch methods are needed
+		if not self.dense:
+			raise Exception("Training in batches needs the phase space methods")
+		if type(self).startBatch is RFLearner.startBatch:
+			raise Exception(f"{type(self).__name__} does not implement the batch methods, see startBatch")
+
+	def _trainBatch(self, size):
+		# Same as train, with size episodes a step. All the Q updates of a
+		# step are scattered into the table at once, so when two episodes
+		# update the same state and action in the same step one of them wins
+		num_actions = len(self._actions)
+		starts = range(0, self.epochs, size)
+		for start in progress_bar(starts, len(starts), length=10):
+			count = min(size, self.epochs - start)
+			states = self.startBatch(count)
+			current = self._rows(self.toPhaseSpaceBatch(states))
+
+			counter = 0
+			done = self.reachedGoalBatch(states, counter)
+			while not done.all():
+				counter += 1
+				greedy = self.Q_table[current].argmax(axis=1)
+				explore = np.random.rand(count) < self.exploration_prob
+				actions = np.where(explore, np.random.randint(num_actions, size=count), greedy)
+
+				next_states, valid = self.applyActionBatch(states, actions)
+				rewards = self.rewardBatch(next_states)
+				following = self._rows(self.toPhaseSpaceBatch(next_states))
+				Q = self.Q_table
+
+				# Invalid states will not be acceptable
+				banned = ~done & ~valid
+				Q[current[banned], actions[banned]] = -np.inf
+
+				if self.visits is not None:
+					np.add.at(self.visits, (current[~done], actions[~done]), 1)
+
+				learn = ~done & ~banned
+				rows, acts = current[learn], actions[learn]
+				Q[rows, acts] += self.learning_rate * \
+					(rewards[learn] + self.discount_factor * Q[following[learn]].max(axis=1) - Q[rows, acts])
+
+				current = np.where(learn, following, current)
+				states = next_states
+				done = done | self.reachedGoalBatch(states, counter)
+
 	@final
 	def run(self, start_user_state=None):
 		if start_user_state == None:
@@ -141,7 +539,7 @@ class RFLearner(ABC):
 		while not self.reachedGoal(current_state, counter):
 			counter += 1
 			yield current_state
-			action = np.argmax(self.Q_table[current_state])
+			action = np.argmax(self._values(current_state))
 
 			next_state = self._applyAction(current_state, action)
 			if not self._validState(next_state):
@@ -158,4 +556,70 @@ class RFLearner(ABC):
 	def _validState(self, state):
 		if state == False:
 			return False
-		return self.validState(state)
\ No newline at end of file
+		return self.validState(state)
+
+	def _trainParallel(self, workers, batch=None, sync_every=None):
+		# Every worker process trains its own copy of the table for
+		# sync_every episodes, each with its own random seed. Then their
+		# changes are merged back in, weighted by how often each worker
+		# tried that action in that state, and everyone starts the next
+		# round from the merged table
+		if not self.dense:
+			raise Exception("Training with workers needs the phase space methods")
+		if sync_every is None:
+			# Around 10 rounds in total, but never less than a full batch
+			sync_every = max(batch or 1, self.epochs // (10 * workers))
+		rounds = range(0, self.epochs, sync_every * workers)
+		with multiprocessing.Pool(workers) as pool:
+			for start in progress_bar(rounds, len(rounds), length=10):
+				left = self.epochs - start
+				jobs = [
+					(self, np.random.randint(2**32), min(sync_every, left - i * sync_every), batch)
+					for i in range(workers) if left > i * sync_every
+				]
+				self._merge(pool.map(_trainWorker, jobs))
+
+	def _merge(self, results):
+		# results are (state ids, new values, visits) for the rows a
+		# worker touched, each worker started from our current table
+		ids = np.concatenate([r[0] for r in results])
+		rows = self._rows(ids)
+		values = np.concatenate([r[1] for r in results])
+		visits = np.concatenate([r[2] for r in results])
+		Q = self.Q_table
+
+		unique, inverse = np.unique(rows, return_inverse=True)
+		before = Q[rows]
+		# Anything a worker found to be illegal stays that way
+		banned = np.zeros((len(unique), len(self._actions)), dtype=bool)
+		np.logical_or.at(banned, inverse, (values == -np.inf) & (visits > 0))
+		finite = np.isfinite(before) & np.isfinite(values)
+		with np.errstate(invalid="ignore"):
+			change = np.where(finite, visits * (values.astype(np.float64) - before), 0)
+		total_change = np.zeros((len(unique), len(self._actions)))
+		total_visits = np.zeros((len(unique), len(self._actions)))
+		np.add.at(total_change, inverse, change)
+		np.add.at(total_visits, inverse, np.where(finite, visits, 0))
+
+		merged = Q[unique] + np.where(total_visits > 0, total_change / np.maximum(total_visits, 1), 0)
+		merged[banned] = -np.inf
+		Q[unique] = merged
+
+
+def _trainWorker(job):
+	# One round of train(workers=...), in a worker process
+	learner, seed, epochs, batch = job
+	np.random.seed(seed)
+	learner.epochs = epochs
+	learner.visits = np.zeros(learner.Q_table.shape, dtype=np.int64)
+	# One progress bar is plenty
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		learner.train(batch)
+	touched = np.flatnonzero(learner.visits.any(axis=1))
+	if learner.row_of is None:
+		ids = touched
+	else:
+		ids = np.zeros(len(learner.row_of), dtype=np.int64)
+		ids[list(learner.row_of.values())] = list(learner.row_of.keys())
+		ids = ids[touched]
+	return ids, learner.Q_table[touched], learner.visits[touched]
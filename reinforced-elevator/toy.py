@@ -3,6 +3,9 @@ import numpy as np
 import math
 
 class ToyProblem(RFLearner):
+	# Moving around the board never depends on anything but where we are
+	deterministic = True
+
 	def __init__(self, board="", **kwargs):
 		self.environment = board.strip().split('\n')
 
@@ -22,6 +25,15 @@ class ToyProblem(RFLearner):
 	def getActions(self):
 		return ["up", "left", "right", "down"]
 
+	def totalNumStates(self):
+		return self.width * self.height
+
+	def toPhaseSpace(self, user_state):
+		return user_state[0] + user_state[1] * self.width
+
+	def fromPhaseSpace(self, idx):
+		return (idx % self.width, idx // self.width)
+
 	def reward(self, next_state):
 		# Bonking a wall is bad
 		if self.goal == next_state: